@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""Benchmarks for multiset enumeration, weighting and probability engines.
+
+    Each case runs one function over a grid of (n, m) and reports the
+    best wall time over several repeats, the throughput in multisets
+    per second (the number of multisets with that sum and length, see
+    Multiset.num_uniq_msets(), divided by the wall time) and the peak
+    resident memory. Results are written as JSON, so that runs from
+    two commits can be compared::
+
+        python -m benchmarks.bench_pymsetmath -o before.json
+        git checkout <other commit>
+        python -m benchmarks.bench_pymsetmath --compare before.json
+
+    By default each case runs in a child process, so that its peak
+    memory is not inflated by earlier cases. A fresh Multiset is used
+    for each repeat, so factorial caching is included in the timings.
+
+"""
+
+import json
+from multiprocessing import Pipe, Process
+from optparse import OptionParser
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from pymsetmath import examples
+from pymsetmath.multiset import Multiset
+
+DEFAULT_GRID = '20x4,40x5,60x6,100x5'
+
+def exhaust(iterable):
+    """Consume an iterable and return the number of items."""
+    count = 0
+    for item in iterable:
+        count += 1
+    return count
+
+def bench_uniq_msets(n, m):
+    """Walk every multiset with Multiset.uniq_msets()."""
+    return lambda: exhaust(Multiset().uniq_msets(n, m))
+
+def bench_num_ways(n, m):
+    """Sum the number of ways of every key with Multiset.num_ways()."""
+    return lambda: exhaust(Multiset().num_ways(n, m))
+
+def bench_num_uniq_msets(n, m):
+    """Count the multisets with Multiset.num_uniq_msets()."""
+    return lambda: Multiset().num_uniq_msets(n, m)
+
+def bench_multinomial_coeff(n, m):
+    """Compute the multinomial coefficient of every multiset."""
+    msets = list(Multiset().uniq_msets(n, m))
+    def run():
+        multinomial_coeff = Multiset().multinomial_coeff
+        for mset in msets:
+            multinomial_coeff(mset)
+    return run
+
+def bench_compute_probabilities(n, m):
+    """Compute every row of examples.compute_probabilities()."""
+    return lambda: exhaust(examples.compute_probabilities(n, m))
+
+def bench_count_ways_to_obtain_largest_subpopulation(n, m):
+    """Run examples.count_ways_to_obtain_largest_subpopulation()."""
+    return lambda: examples.count_ways_to_obtain_largest_subpopulation(n, m)
+
+CASES = (
+    ('uniq_msets', bench_uniq_msets),
+    ('num_ways', bench_num_ways),
+    ('num_uniq_msets', bench_num_uniq_msets),
+    ('multinomial_coeff', bench_multinomial_coeff),
+    ('compute_probabilities', bench_compute_probabilities),
+    ('count_ways_to_obtain_largest_subpopulation',
+     bench_count_ways_to_obtain_largest_subpopulation),
+)
+
+def parse_grid(text):
+    """Parse a grid such as '20x4,40x5' into a list of (n, m)."""
+    grid = []
+    for item in text.split(','):
+        try:
+            (n, m) = [int(val) for val in item.strip().split('x')]
+        except ValueError:
+            print "Grid entries must look like 20x4, not %r." % item
+            raise
+        grid.append((n, m))
+    return grid
+
+def max_rss():
+    """Return the peak resident memory of this process in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024        # reported in bytes rather than kilobytes
+    return peak
+
+def run_case(name, bench, n, m, repeat):
+    """Time one case in this process and return a result dict."""
+    run = bench(n, m)
+    start_rss = max_rss()
+    seconds = None
+    for ix in xrange(repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    multisets = Multiset().num_uniq_msets(n, m)
+    return {'name': name, 'n': n, 'm': m, 'seconds': seconds,
+            'multisets': multisets,
+            'multisets_per_sec': multisets / seconds if seconds else None,
+            'max_rss_kb': max_rss(), 'start_rss_kb': start_rss}
+
+def _run_child(conn, name, bench, n, m, repeat):
+    """Send the result of run_case(), or the error it raised, to conn."""
+    try:
+        result = run_case(name, bench, n, m, repeat)
+    except Exception as error:
+        result = {'name': name, 'n': n, 'm': m, 'error': repr(error)}
+    conn.send(result)
+    conn.close()
+
+def run_isolated(name, bench, n, m, repeat):
+    """Time one case in a child process and return a result dict.
+
+    A case that fails, or whose process dies (for example when it runs
+    out of memory), returns a dict of its name, n, m and error.
+
+    """
+
+    (parent, child) = Pipe(duplex=False)
+    proc = Process(target=_run_child,
+                   args=(child, name, bench, n, m, repeat))
+    proc.start()
+    # keep only the child's end open, so that recv() sees its exit
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    parent.close()
+    if result is None:
+        result = {'name': name, 'n': n, 'm': m,
+                  'error': 'process exited with code %s' % proc.exitcode}
+    return result
+
+def git_revision():
+    """Return the current git commit, or None outside of a checkout."""
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = proc.communicate()[0]
+    except OSError:
+        return None
+    return out.strip() or None
+
+def compare(results, baseline, tolerance):
+    """Print time ratios against a baseline and return the regressions."""
+    before = dict(((row['name'], row['n'], row['m']), row)
+                  for row in baseline['results'])
+    regressions = []
+    print '%-42s %9s %10s %10s %7s' % ('case', '(n, m)', 'before',
+                                       'after', 'ratio')
+    for row in results:
+        key = (row['name'], row['n'], row['m'])
+        if key not in before or 'error' in row or 'error' in before[key]:
+            continue
+        ratio = row['seconds'] / max(before[key]['seconds'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print '%-42s %9s %10.4f %10.4f %7.2f%s' % (
+            row['name'], '(%d, %d)' % (row['n'], row['m']),
+            before[key]['seconds'], row['seconds'], ratio, flag)
+    return regressions
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-g', '--grid', default=DEFAULT_GRID,
+                      help='comma-separated NxM pairs [%default]')
+    parser.add_option('-c', '--case', action='append', dest='cases',
+                      help='run only this case (may be repeated)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='repeats per case; the best time is kept '
+                           '[%default]')
+    parser.add_option('-o', '--output',
+                      help='write JSON results to this file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare times with an earlier JSON result')
+    parser.add_option('--tolerance', type='float', default=0.1,
+                      help='slowdown ratio above 1 reported as a '
+                           'regression [%default]')
+    parser.add_option('--inline', action='store_true', default=False,
+                      help='run cases in this process instead of children')
+    (options, args) = parser.parse_args(argv)
+
+    names = [name for (name, bench) in CASES]
+    for name in options.cases or ():
+        if name not in names:
+            parser.error('unknown case %r; choose from %s' %
+                         (name, ', '.join(names)))
+    run = run_case if options.inline else run_isolated
+    results = []
+    for (name, bench) in CASES:
+        if options.cases and name not in options.cases:
+            continue
+        for (n, m) in parse_grid(options.grid):
+            row = run(name, bench, n, m, options.repeat)
+            results.append(row)
+            if 'error' in row:
+                print '%-42s %9s failed: %s' % (
+                    name, '(%d, %d)' % (n, m), row['error'])
+                sys.stdout.flush()
+                continue
+            print '%-42s %9s %10.4f s %12.0f multisets/s %8d kB' % (
+                name, '(%d, %d)' % (n, m), row['seconds'],
+                row['multisets_per_sec'] or 0, row['max_rss_kb'])
+            sys.stdout.flush()
+
+    report = {'commit': git_revision(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'repeat': options.repeat,
+              'results': results}
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            json.dump(report, out, indent=1, sort_keys=True)
+        finally:
+            out.close()
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
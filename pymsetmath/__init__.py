@@ -1 +1 @@
-__all__ = ["multiset", "examples"]
+__all__ = ["multiset", "examples", "service", "batch"]
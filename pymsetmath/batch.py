@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""Answer a stream of probability queries across processes.
+
+    Each input record is a query (n, m, t): n top results, m workers and
+    an optional count t. Records are read as JSON lines or as CSV with a
+    header, from a file or stdin::
+
+        {"n": 100, "m": 10, "t": 21}
+        {"n": 1000, "m": 64}
+
+    and answered as JSON lines, in input order::
+
+        python -m pymsetmath.batch -j 4 queries.jsonl > answers.jsonl
+
+    A query with t gets the probability p that some worker holds t or
+    more of the top n results (the p of compute_probabilities(n, m, t)
+    whose count is t); a query without t gets the whole table, as
+    columns 'count' and 'p'. An invalid record is answered by a line
+    with its line number and an error, so one bad record does not stop
+    a long run.
+
+    Records are read up to a window ahead of the answers written. The
+    distinct queries read but not answered recently are handed out
+    largest first, by the cost predicted by examples.explain(), and a
+    new query is handed out as soon as any process finishes one, so
+    that one slow query does not leave the other processes idle. Only
+    one window of records and a bounded cache of recent answers are
+    held in memory. A query whose computation fails is answered by an
+    error line, like an invalid record.
+
+:Author: Hy Carrinski
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+from collections import defaultdict, deque, OrderedDict
+import csv
+from heapq import heappop, heappush
+from itertools import chain
+import json
+from multiprocessing import Pool
+from optparse import OptionParser
+from Queue import Queue
+import sys
+
+from pymsetmath.examples import compute_probabilities, explain, ENGINES
+from pymsetmath.multiset import is_nonneg_int
+
+def read_queries(stream, format=None):
+    """Yield a (line, query) pair for each record of stream.
+
+    Inputs
+      :stream: iterable of lines, such as a file or sys.stdin
+      :format: 'jsonl', 'csv' or None to guess from the first line
+               (a line starting with '{' is JSON)
+
+    Yields
+      :pair: tuple of the line number of the record and either a key
+             (n, m, t), with t None when absent, or a string explaining
+             why the record is invalid
+
+    """
+
+    lines = ((number, line) for (number, line) in enumerate(stream, 1)
+             if line.strip())
+    for (number, line) in lines:
+        break
+    else:
+        raise StopIteration
+    lines = chain([(number, line)], lines)
+    if format is None:
+        format = 'jsonl' if line.lstrip().startswith('{') else 'csv'
+    if format == 'jsonl':
+        for (number, line) in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, _as_query(record)
+    elif format == 'csv':
+        header = [name.strip() for name in _csv_row(next(lines)[1])]
+        for (number, line) in lines:
+            values = [value.strip() for value in _csv_row(line)]
+            yield number, _as_query(dict(zip(header, values)))
+    else:
+        print "Query format must be 'jsonl' or 'csv', not %r." % format
+        raise ValueError
+
+def _csv_row(line):
+    """Return the fields of one line of CSV."""
+    return next(csv.reader([line]))
+
+def _as_query(record):
+    """Return the key (n, m, t) of a record, or why it is invalid."""
+    if not isinstance(record, dict):
+        return 'expected a JSON object'
+    query = []
+    for name in ('n', 'm', 't'):
+        value = record.get(name)
+        if isinstance(value, basestring):
+            try:
+                value = int(value) if value else None
+            except ValueError:
+                return 'expected an integer %s' % name
+        query.append(value)
+    (n, m, t) = query
+    if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+        return 'expected non-negative n and positive m'
+    if t is not None and not is_nonneg_int(t):
+        return 'expected non-negative t'
+    return int(n), int(m), (None if t is None else int(t))
+
+def answer(query, engine='auto', precision=None):
+    """Return the answer to one query (n, m, t) as a dict.
+
+    Inputs
+      :query: tuple (n, m, t) of read_queries(), with t None for a table
+      :engine: engine of compute_probabilities(), or 'auto'
+      :precision: with engine 'auto', largest acceptable error of p
+
+    Output
+      :result: dict of n, m and t with p, the probability that some
+               worker holds t or more of the top n results; without t,
+               dict of n, m and the columns 'count' and 'p' of the table
+
+    """
+
+    (n, m, t) = query
+    if t is None:
+        rows = list(compute_probabilities(n, m, engine=engine,
+                                          precision=precision))
+        return {'n': n, 'm': m, 'count': [row['count'] for row in rows],
+                'p': [row['p'] for row in rows]}
+    rows = list(compute_probabilities(n, m, t, engine=engine,
+                                      precision=precision))
+    if rows and rows[-1]['count'] == t:
+        p = rows[-1]['p']
+    else:
+        # no rows below the lowest count; every row below a t above n
+        p = 0.0 if rows else 1.0
+    return {'n': n, 'm': m, 't': t, 'p': p}
+
+def _answer_pair(args):
+    """Return the query and its answer, or a dict of why it failed."""
+    (query, engine, precision) = args
+    try:
+        return query, answer(query, engine, precision)
+    except Exception as error:
+        return query, {'error': 'failed: %r' % (error,)}
+
+def _quiet():
+    """Keep messages printed by a worker out of the JSON on stdout."""
+    sys.stdout = sys.stderr
+
+def _cost(query, engine, precision):
+    """Return the run time of a query predicted by explain()."""
+    (n, m, t) = query
+    plan = explain(n, m, () if t is None else t, precision)
+    return plan['costs'].get(engine, plan['cost'])
+
+def run_batch(pairs, processes=None, engine='auto', precision=None,
+              window=1024, cache_size=10000):
+    """Yield the answer to each query of read_queries(), in input order.
+
+    Inputs
+      :pairs: iterable of (line, query) pairs, as from read_queries()
+      :processes: optional number of worker processes (default: serial)
+      :engine: engine of compute_probabilities(), or 'auto'
+      :precision: with engine 'auto', largest acceptable error of p
+      :window: largest number of records read ahead of the answers
+      :cache_size: number of recent answers reused without computing
+
+    Yields
+      :result: the dict of answer() for a valid query, or a dict of its
+               line and error for an invalid one or one whose computation
+               failed; identical queries share one dict
+
+    Implementation
+        Distinct new queries wait in a heap ordered by cost, and at most
+        ``2 * processes`` of them are in the pool at once; each one is
+        submitted with apply_async(), whose callback queues its answer,
+        and the next is submitted as soon as an answer arrives. Answers
+        are yielded once those of all earlier records are known.
+
+    """
+
+    if engine != 'auto' and engine not in ENGINES:
+        print "Engine must be 'auto' or one of %s." % ', '.join(ENGINES)
+        raise ValueError
+    done = Queue()
+    if processes is None:
+        pool = None
+        slots = 1
+    else:
+        pool = Pool(processes, _quiet)
+        slots = 2 * processes
+    pairs = iter(pairs)
+    records = deque()
+    # answers of the queries of records, and how many records need each
+    answers = {}
+    needed = defaultdict(int)
+    (todo, running, order) = ([], 0, 0)
+    recent = OrderedDict()
+    read_all = False
+    try:
+        while True:
+            while not read_all and len(records) < window:
+                pair = next(pairs, None)
+                if pair is None:
+                    read_all = True
+                    break
+                records.append(pair)
+                query = pair[1]
+                if not isinstance(query, tuple):
+                    continue
+                needed[query] += 1
+                if needed[query] > 1:
+                    continue
+                if query in recent:
+                    answers[query] = recent.pop(query)
+                    recent[query] = answers[query]
+                else:
+                    order += 1
+                    heappush(todo, (-_cost(query, engine, precision),
+                                    order, query))
+            while todo and running < slots:
+                args = (heappop(todo)[2], engine, precision)
+                running += 1
+                if pool is None:
+                    done.put(_answer_pair(args))
+                else:
+                    pool.apply_async(_answer_pair, (args,),
+                                     callback=done.put)
+            while records and (not isinstance(records[0][1], tuple) or
+                               records[0][1] in answers):
+                (number, query) = records.popleft()
+                if not isinstance(query, tuple):
+                    yield {'line': number, 'error': query}
+                    continue
+                result = answers[query]
+                needed[query] -= 1
+                if not needed[query]:
+                    del needed[query]
+                    del answers[query]
+                if 'error' in result:
+                    yield dict(result, line=number)
+                else:
+                    yield result
+            if read_all and not records:
+                break
+            if running:
+                (query, result) = done.get()
+                running -= 1
+                answers[query] = result
+                if 'error' not in result:
+                    recent[query] = result
+                    while len(recent) > cache_size:
+                        recent.popitem(last=False)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _write_answers(stream, out, options):
+    """Write the answers to the queries of stream to out."""
+    pairs = read_queries(stream, options.format)
+    for result in run_batch(pairs, options.processes, options.engine,
+                            options.precision, options.window):
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [FILE]')
+    parser.add_option('-j', '--processes', type='int',
+                      help='worker processes (default: serial)')
+    parser.add_option('-f', '--format', choices=('jsonl', 'csv'),
+                      help='input format, jsonl or csv (default: guessed)')
+    parser.add_option('-e', '--engine', default='auto',
+                      choices=('auto',) + ENGINES,
+                      help='engine of compute_probabilities() [%default]')
+    parser.add_option('--precision', type='float',
+                      help='with engine auto, largest acceptable error of p '
+                           '(default: exact)')
+    parser.add_option('-w', '--window', type='int', default=1024,
+                      help='records answered at a time [%default]')
+    parser.add_option('-o', '--output',
+                      help='write answers to this file (default: stdout)')
+    (options, args) = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error('expected at most one input file')
+    out = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        if args and args[0] != '-':
+            with open(args[0]) as stream:
+                _write_answers(stream, out, options)
+        else:
+            _write_answers(sys.stdin, out, options)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -56,17 +56,32 @@
 
 __docformat__ = 'restructuredtext'
 
+from bisect import bisect_left
 from collections import defaultdict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from fractions import Fraction, gcd
+from itertools import groupby
+from math import erf, exp, expm1, log, log1p, pi, sqrt
+import mmap
+from operator import truediv
+import os
+import struct
+import sys
 
-from pymsetmath.multiset import Multiset, is_nonneg_int
+from pymsetmath.multiset import (Instrument, Multiset, is_nonneg_int,
+                                  numpy, PartitionTable, _atomic_write)
 
-def count_ways_to_obtain_largest_subpopulation(n, m):
+def count_ways_to_obtain_largest_subpopulation(n, m, instrument=None):
     """Return dict of number of ways to obtain largest subpopulation.
 
     Inputs
       :n: total number (e.g., total number of highest scoring results)
       :m: number of non-negative integers to sum to n (e.g., number of
           workers)
+      :instrument: optional multiset.Instrument for counters and progress
 
     Output
       :ways: dictionary whose keys are the maximum value of a multiset
@@ -76,24 +91,87 @@ def count_ways_to_obtain_largest_subpopulation(n, m):
              a maximum value.
 
     Implementation
-        Although Multiset.uniq_msets() returns tuples in lexicographical
+        Although Multiset.weighted_msets() returns tuples in lexicographical
         order, this implementation would function regardless of order.
 
     """
-    mset = Multiset(n)
+    mset = Multiset(n, instrument)
     ways = defaultdict(int)
-    for grp in mset.uniq_msets(n, m):
-        ways[max(grp)] += (mset.multinomial_coeff(grp) *
-                           mset.number_of_arrangements(grp))
+    for (grp, weight) in mset.weighted_msets(n, m, buffer=True):
+        ways[grp[0]] += weight
     return ways
 
-def compute_all_probabilities(n, m):
+ENGINES = ('enumerate', 'dp', 'numpy')
+
+EPSILON = sys.float_info.epsilon
+LOG_EPSILON = log(EPSILON)
+# relative rounding tolerated when comparing bounds against a threshold
+BOUND_SLACK = 1e-9
+
+def as_denominator(total):
+    """Return total as a float, or unchanged when too large for a float.
+
+    Dividing a count by the result with operator.truediv() gives the same
+    value as the historical ``count / float(total)`` whenever total fits
+    in a float, and a correctly rounded ratio of big integers otherwise.
+
+    """
+
+    try:
+        return float(total)
+    except OverflowError:
+        return total
+
+def count_ways(mset, n, m, engine='enumerate', processes=None,
+               reverse=False, checkpoint=None):
+    """Yield (count, ways) in ascending order of count using an engine.
+
+    Inputs
+      :mset: Multiset instance whose factorial cache is used
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of non-negative integers to sum to n (e.g., number of
+          workers)
+      :engine: name of the method used to compute the number of ways
+          * 'enumerate' walks every multiset from Multiset.uniq_msets()
+          * 'dp' counts bounded arrangements without enumerating multisets
+          * 'numpy' enumerates and weights multisets in numpy batches
+      :processes: optional number of worker processes for 'enumerate'
+      :reverse: if True, yield in descending order of count ('enumerate'
+                and 'dp' only)
+      :checkpoint: optional path of a checkpoint file ('enumerate' only,
+                   see Multiset.num_ways())
+
+    Output
+      :ways: tuples of the largest number of results on any worker and
+             the number of the m ** n arrangements sharing that maximum
+
+    Exceptions
+      raises ValueError for an unknown engine
+
+    """
+
+    if engine == 'enumerate':
+        return mset.num_ways(n, m, processes=processes, reverse=reverse,
+                             checkpoint=checkpoint)
+    elif checkpoint is not None:
+        print "Checkpoints require the 'enumerate' engine."
+        raise ValueError
+    elif engine == 'dp':
+        return mset.num_ways_dp(n, m, reverse)
+    elif engine == 'numpy' and not reverse:
+        return mset.num_ways_batched(n, m)
+    print "Unsupported engine %r; choose one of %s." % (engine, ENGINES)
+    raise ValueError
+
+def compute_all_probabilities(n, m, engine='enumerate', instrument=None):
     """Compute probability that a result is missed.
 
     Inputs
       :n: total number (e.g., total number of highest scoring results)
       :m: number of non-negative integers to sum to n (e.g., number of
           workers, each returning an integer number of results)
+      :engine: name of the method used to count ways (see count_ways())
+      :instrument: optional multiset.Instrument for counters and progress
 
     Output
       :stats: dict containing fields:
@@ -109,20 +187,204 @@ def compute_all_probabilities(n, m):
       number ways n elements from the m categories in each grouping
       can be arranged). The sum over all of these products is m ** n.
 
+      The 'dp' engine yields identical output at a cost of about
+      O(n ** 2 * log(n)) big integer operations, which makes cases
+      such as n=1000, m=64 practical.
+
     """
 
     numerator = m ** n
     # Decimal can be exact, but float is good enough.
-    denominator = float(numerator)
+    denominator = as_denominator(numerator)
     stats = {'n': n, 'm': m, 'count': 0, 'p': 0}
-    ways = count_ways_to_obtain_largest_subpopulation(n, m)
-    for cnt in sorted(ways.keys()):
+    if engine == 'enumerate':
+        by_max = count_ways_to_obtain_largest_subpopulation(n, m, instrument)
+        counts = ((cnt, by_max[cnt]) for cnt in sorted(by_max.keys()))
+    else:
+        counts = count_ways(Multiset(n, instrument), n, m, engine)
+    for (cnt, ways) in counts:
         stats['count'] = cnt
-        stats['p'] = numerator / denominator
+        stats['p'] = truediv(numerator, denominator)
         yield stats.copy()
-        numerator -= ways[cnt]
+        numerator -= ways
+
+def compute_expected_misses(n, m):
+    """Compute the expected number of missed top results for every k.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of workers
+
+    Output
+      :stats: dict for each k from 0 to n containing fields:
+          * k is the number of results returned per worker
+          * n is the total number of highest scoring results
+          * m is the number of workers
+          * expected is the expected number of the top n results missed
+          * recall is the expected fraction of them returned
+
+    Implementation
+        A worker holding j of the top n results misses ``max(0, j - k)``
+        of them, and j is binomial with ``P(j) = C(n, j) (m - 1) **
+        (n - j) / m ** n``. By linearity, the expected number missed is
+        m times the expectation for one worker, so::
 
-def compute_probabilities(n, m, t=()):
+            m ** n * expected = m * sum((j - k) * w[j] for j > k)
+
+        with ``w[j] = C(n, j) * (m - 1) ** (n - j)``. The sums of ``w[j]``
+        and ``j * w[j]`` above k are accumulated once, from k = n down, in
+        exact integers, and each row costs O(1) big integer operations.
+
+        >>> for stats in compute_expected_misses(5, 2):
+        ...     print stats['k'], stats['expected']
+        0 5.0
+        1 3.0625
+        2 1.4375
+        3 0.4375
+        4 0.0625
+        5 0.0
+
+    """
+
+    if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+        print "Expected misses require non-negative n and positive m."
+        raise ValueError
+    denominator = as_denominator(m ** n)
+    # w[j] from j = n down, using C(n, j - 1) (n - j + 1) = C(n, j) j
+    weight = 1
+    (above, moment) = (0, 0)
+    numerators = [0] * (n + 1)
+    for k in xrange(n - 1, -1, -1):
+        j = k + 1
+        above += weight
+        moment += j * weight
+        numerators[k] = m * (moment - k * above)
+        weight = weight * (m - 1) * j // (n - j + 1)
+    for k in xrange(n + 1):
+        expected = truediv(numerators[k], denominator)
+        yield {'n': n, 'm': m, 'k': k, 'expected': expected,
+               'recall': 1 - expected / n if n else 1.0}
+
+def _miss_counts(n, m, k):
+    """Return the number of the m ** n arrangements missing each count.
+
+    The d-th element counts arrangements in which the workers, each
+    returning k results, miss exactly d of the top n. With j workers
+    holding more than k results, t of them in all, d = t - j * k, so::
+
+        counts[d] = sum(C(m, j) * C(n, t) * over[j][t] * under[m - j][n - t])
+
+    where over[j][t] places t results on j workers, each more than k,
+    and under[l][u] places u results on l workers, each at most k.
+    Placing the last result either on a worker that already holds
+    enough of the others, or on one that reaches the bound with it,
+    gives recurrences of one step per entry::
+
+        under[l][u] = l * (under[l][u - 1] -
+                           C(u - 1, k) * under[l - 1][u - 1 - k])
+        over[j][t] = j * (over[j][t - 1] +
+                          C(t - 1, k) * over[j - 1][t - 1 - k])
+
+    so the counts take O(m * n) big integer operations.
+
+    """
+
+    most = min(m, n // (k + 1))
+    # choose_k[a] is C(a, k) and choose_n[t] is C(n, t)
+    choose_k = [0] * (n + 1)
+    if k <= n:
+        choose_k[k] = 1
+        for val in xrange(k + 1, n + 1):
+            choose_k[val] = choose_k[val - 1] * val // (val - k)
+    choose_n = [1] * (n + 1)
+    for val in xrange(1, n + 1):
+        choose_n[val] = choose_n[val - 1] * (n - val + 1) // val
+    under = [1] + [0] * n
+    unders = {0: under}
+    for size in xrange(1, m + 1):
+        row = [1] + [0] * n
+        for total in xrange(1, min(n, size * k) + 1):
+            acc = row[total - 1]
+            if total > k:
+                acc -= choose_k[total - 1] * under[total - 1 - k]
+            row[total] = size * acc
+        under = row
+        if size >= m - most:
+            unders[size] = row
+    counts = [0] * (n - k + 1 if n > k else 1)
+    over = [1] + [0] * n
+    choose_m = 1
+    for j in xrange(most + 1):
+        if j:
+            row = [0] * (n + 1)
+            for total in xrange(j * (k + 1), n + 1):
+                row[total] = j * (row[total - 1] + choose_k[total - 1] *
+                                  over[total - 1 - k])
+            over = row
+            choose_m = choose_m * (m - j + 1) // j
+        under = unders[m - j]
+        for total in xrange(j * (k + 1), n + 1):
+            if over[total] and under[n - total]:
+                counts[total - j * k] += (choose_m * choose_n[total] *
+                                          over[total] * under[n - total])
+    return counts
+
+def compute_miss_tails(n, m, t=()):
+    """Compute the distribution of the number of missed top results.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of workers
+      :t: optional largest k (default: every k from 0 to n)
+
+    Output
+      :stats: dict for each k from 0 through t containing fields:
+          * k is the number of results returned per worker
+          * n is the total number of highest scoring results
+          * m is the number of workers
+          * tail is the list whose r-th element is the probability that
+            r or more of the top n results are missed, for r from 0 to
+            the largest possible number missed, ``max(n - k, 0)``
+          * expected is the expected number missed, as
+            compute_expected_misses() gives it
+          * p is the probability that one or more are missed, the p of
+            the row of compute_all_probabilities() whose count is k + 1
+
+    Implementation
+        Counts are exact big integers (see _miss_counts()), in O(m * n)
+        operations for each k, so O(m * n ** 2) in all.
+
+        >>> for stats in compute_miss_tails(5, 2):
+        ...     print stats['k'], stats['tail']
+        0 [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        1 [1.0, 1.0, 1.0, 1.0, 0.0625]
+        2 [1.0, 1.0, 0.375, 0.0625]
+        3 [1.0, 0.375, 0.0625]
+        4 [1.0, 0.0625]
+        5 [1.0]
+
+    """
+
+    if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+        print "Miss tails require non-negative n and positive m."
+        raise ValueError
+    top = min(t, n) if is_nonneg_int(t) else n
+    denominator = as_denominator(m ** n)
+    expectations = compute_expected_misses(n, m)
+    for k in xrange(top + 1):
+        counts = _miss_counts(n, m, k)
+        (tail, acc) = ([], 0)
+        for count in reversed(counts):
+            acc += count
+            tail.append(truediv(acc, denominator))
+        tail.reverse()
+        yield {'n': n, 'm': m, 'k': k, 'tail': tail,
+               'expected': next(expectations)['expected'],
+               'p': tail[1] if len(tail) > 1 else 0.0}
+
+def compute_probabilities(n, m, t=(), engine='enumerate', processes=None,
+                          instrument=None, checkpoint=None, precision=None,
+                          seed=None):
     """Compute probability that a result is missed.
 
     Inputs
@@ -131,6 +393,18 @@ def compute_probabilities(n, m, t=()):
           workers, each returning an integer number of results)
       :t: optional threshold to short-circuit computation
           * integer t is the maximum number of results to return per worker
+      :engine: name of the method used to count ways (see count_ways()),
+               or 'auto' to run the cheapest strategy chosen by explain()
+      :processes: optional number of worker processes (see count_ways())
+      :instrument: optional multiset.Instrument for counters and progress
+      :checkpoint: optional path of a file from which an interrupted run
+                   resumes, yielding the same rows (see count_ways()); with
+                   engine 'auto', 'enumerate' is used, since it is the
+                   only engine that checkpoints
+      :precision: with engine 'auto', the largest acceptable absolute
+                  error of p (default: exact values only)
+      :seed: optional seed of the 'sample' strategy of engine 'auto',
+             for reproducible estimates
 
     Output
       :stats: dict containing fields:
@@ -138,18 +412,41 @@ def compute_probabilities(n, m, t=()):
           * n is the total number of highest scoring results
           * m is the number of workers
           * p is the cumulative probability that a result is missed
+          approximate strategies add the fields of their own functions
 
     """
 
+    if engine == 'auto' and checkpoint is not None:
+        engine = 'enumerate'
+    if engine == 'auto':
+        plan = explain(n, m, t, precision, processes)
+        for name in plan['order']:
+            if name == 'log':
+                rows = list(compute_log_probabilities(n, m, t))
+                if all(stats['p'] * stats['rel_err'] <= precision
+                       for stats in rows):
+                    for stats in rows:
+                        yield stats
+                    raise StopIteration
+            elif name == 'sample':
+                for stats in compute_sampled_probabilities(n, m, t,
+                                                           precision,
+                                                           seed=seed):
+                    yield stats
+                raise StopIteration
+            else:
+                engine = name
+                break
     if not is_nonneg_int(t):
         t = ()
     numerator = m ** n
-    denominator = float(numerator)
+    denominator = as_denominator(numerator)
     stats = {'n': n, 'm': m, 'count': 0, 'p': 0}
-    mset = Multiset(n)
-    for (cnt, ways) in mset.num_ways(n, m):
+    mset = Multiset(n, instrument)
+    for (cnt, ways) in count_ways(mset, n, m, engine, processes,
+                                  checkpoint=checkpoint):
         stats['count'] = cnt
-        stats['p'] = numerator / denominator
+        stats['p'] = truediv(numerator, denominator)
         if cnt < t:
             yield stats.copy()
         elif cnt == t:
@@ -159,6 +456,1080 @@ def compute_probabilities(n, m, t=()):
             raise StopIteration
         numerator -= ways
 
+def compute_tail_probabilities(n, m, epsilon=1.0, engine='enumerate',
+                               processes=None, instrument=None):
+    """Compute probability that a result is missed, starting from the tail.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of non-negative integers to sum to n (e.g., number of
+          workers, each returning an integer number of results)
+      :epsilon: stop after the first row whose p exceeds epsilon
+      :engine: name of the method used to count ways (see count_ways())
+      :processes: optional number of worker processes (see count_ways())
+      :instrument: optional multiset.Instrument for counters and progress
+
+    Output
+      :stats: the rows of compute_all_probabilities() in descending order
+              of count, through the first row whose p exceeds epsilon
+
+    Notes
+      Each p is the sum of the ways at or above its count, accumulated
+      directly rather than subtracted from m ** n, and equals the p of the
+      matching row of compute_all_probabilities(). The 'enumerate' engine
+      visits multisets in reverse (Multiset.uniq_msets(reverse=True)), so
+      for a small epsilon only the few multisets with a large maximum are
+      ever visited.
+
+      >>> for stats in compute_tail_probabilities(5, 2, epsilon=0.1):
+      ...     print stats['count'], stats['p']
+      5 0.0625
+      4 0.375
+
+    """
+
+    numerator = 0
+    denominator = as_denominator(m ** n)
+    stats = {'n': n, 'm': m, 'count': 0, 'p': 0}
+    mset = Multiset(n, instrument)
+    for (cnt, ways) in count_ways(mset, n, m, engine, processes, True):
+        numerator += ways
+        stats['count'] = cnt
+        stats['p'] = truediv(numerator, denominator)
+        yield stats.copy()
+        if stats['p'] > epsilon:
+            raise StopIteration
+
+def _shard_groups(weights):
+    """Return a dict of integer shard weight to shard count, and the total.
+
+    Weights are taken exactly (as fractions.Fraction) and scaled to the
+    smallest integers in the same proportion. Shards of zero weight never
+    hold a result and are left out.
+
+    """
+
+    fracs = [Fraction(weight) for weight in weights]
+    if not fracs or min(fracs) < 0 or max(fracs) == 0:
+        print "Shard weights must be non-negative and not all zero."
+        raise ValueError
+    scale = 1
+    for frac in fracs:
+        scale = scale * frac.denominator // gcd(scale, frac.denominator)
+    sizes = [int(frac * scale) for frac in fracs]
+    common = reduce(gcd, sizes)
+    groups = defaultdict(int)
+    for size in sizes:
+        if size:
+            groups[size // common] += 1
+    return groups, sum(size // common for size in sizes)
+
+def compute_weighted_probabilities(n, weights, t=()):
+    """Compute probability that a result is missed when shards differ in size.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :weights: sequence of the probability, or the size, of each shard
+                (e.g., its number of documents); only proportions matter
+      :t: optional threshold, as for compute_probabilities()
+
+    Output
+      :stats: dict for each count, as from compute_all_probabilities(),
+              with m the number of shards and p the probability that some
+              shard holds count or more of the top n results, when each
+              result falls in a shard with probability proportional to
+              its weight
+
+    Implementation
+        With integer weights w[i] summing to W, the number of the W ** n
+        weighted arrangements that leave every shard at most k results
+        is n! times the coefficient of ``x ** n`` in the product over
+        shards of ``E(w[i] * x)``, where E is the exponential series
+        truncated after ``x ** k / k!``. Shards of equal weight are
+        grouped: for g of them, ``u! [x**u] E(w * x) ** g`` is ``w ** u``
+        times Multiset.bounded_ways_by_total(). The groups are multiplied
+        as truncated polynomials in exact integers (each coefficient u
+        scaled by ``n! / u!``), and only the coefficient of ``x ** n`` of
+        the last product is needed, so beyond the bounded counts each
+        row costs O(n) operations for up to two distinct weights and
+        O(n ** 2) for each further one. Equal weights give the same
+        values as the 'dp' engine of compute_all_probabilities().
+
+        Floating point weights are taken exactly, which can make the
+        integers long (e.g., 0.1 has 55 bits); prefer integer sizes.
+
+        >>> for stats in compute_weighted_probabilities(4, (1, 3)):
+        ...     print stats['count'], stats['p']
+        2 1.0
+        3 0.7890625
+        4 0.3203125
+
+    """
+
+    if not is_nonneg_int(n):
+        print "Weighted probabilities require a non-negative n."
+        raise ValueError
+    weights = list(weights)
+    (groups, total) = _shard_groups(weights)
+    shards = sum(groups.values())
+    top = min(t, n) if is_nonneg_int(t) else n
+    mset = Multiset(n)
+    # ratios[u] == n! / u!
+    ratios = [1] * (n + 1)
+    for u in xrange(n - 1, -1, -1):
+        ratios[u] = ratios[u + 1] * (u + 1)
+    scale = ratios[0]
+    powers = {}
+    for weight in groups:
+        powers[weight] = [1]
+        for u in xrange(n):
+            powers[weight].append(powers[weight][-1] * weight)
+    numerator = total ** n
+    denominator = as_denominator(numerator)
+    stats = {'n': n, 'm': len(weights), 'count': 0, 'p': 0}
+    for count in xrange(-(-n // shards), top + 1):
+        series = []
+        for (weight, size) in sorted(groups.items()):
+            ways = mset.bounded_ways_by_total(n, size, count - 1)
+            series.append([powers[weight][u] * ways[u] * ratios[u]
+                           for u in xrange(n + 1)])
+        product = series[0]
+        for factor in series[1:-1]:
+            product = [sum(product[v] * factor[u - v]
+                           for v in xrange(u + 1)) // scale
+                       for u in xrange(n + 1)]
+        if len(series) > 1:
+            ways = sum(product[v] * series[-1][n - v]
+                       for v in xrange(n + 1)) // scale
+        else:
+            ways = product[n]
+        stats['count'] = count
+        stats['p'] = truediv(numerator - ways, denominator)
+        yield stats.copy()
+
+def sweep_n(N, m):
+    """Yield the probability table of every total from 1 to N in one pass.
+
+    Inputs
+      :N: largest total number (e.g., of highest scoring results)
+      :m: number of workers
+
+    Output
+      :table: tuple of n and the list of rows of
+              ``compute_all_probabilities(n, m, engine='dp')``, yielded
+              for each n from 1 to N in turn, with identical values
+
+    Implementation
+        The row for count k of total n needs the number of ways that no
+        worker receives more than ``k - 1`` results, and one pass of the
+        recurrence for a bound gives that number for every total up to N
+        (see Multiset.bounded_ways_by_total()). Bounds are processed in
+        increasing order, and the table of n is complete, and yielded,
+        once bound ``n - 1`` is done. The whole sweep costs about as much
+        as ``compute_all_probabilities(N, m, engine='dp')`` alone.
+
+        >>> for (n, table) in sweep_n(3, 2):
+        ...     print n, [(stats['count'], stats['p']) for stats in table]
+        1 [(1, 1.0)]
+        2 [(1, 1.0), (2, 0.5)]
+        3 [(2, 1.0), (3, 0.25)]
+
+    """
+
+    if not (is_nonneg_int(N) and is_nonneg_int(m)) or m == 0:
+        print "Sweeping totals requires non-negative N and positive m."
+        raise ValueError
+    mset = Multiset(N)
+    powers = [1]
+    for n in xrange(N):
+        powers.append(powers[-1] * m)
+    denominators = [as_denominator(power) for power in powers]
+    pending = defaultdict(list)
+    for bound in xrange(N):
+        # count k = bound + 1 is a row for every n from k to m * k
+        upto = min(N, m * (bound + 1))
+        below = mset.bounded_ways_by_total(upto, m, bound)
+        for n in xrange(bound + 1, upto + 1):
+            pending[n].append(truediv(powers[n] - below[n], denominators[n]))
+        n = bound + 1
+        probs = pending.pop(n)
+        first = n - len(probs) + 1
+        yield n, [{'n': n, 'm': m, 'count': first + ix, 'p': p}
+                  for (ix, p) in enumerate(probs)]
+
+def sweep_m(n, m_values):
+    """Compute the probability tables of one total for many worker counts.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m_values: iterable of numbers of workers
+
+    Output
+      :columns: dict of n and of equal-length lists 'm', 'count' and 'p',
+                holding the rows of ``compute_all_probabilities(n, m,
+                engine='dp')`` for each distinct m in ascending order, with
+                identical values
+
+    Implementation
+        For each bound, one pass of the recurrence of
+        Multiset.bounded_ways_by_length() counts the ways for every m at
+        once, building the row for m workers from the row for ``m - 1``.
+        Only bounds below n that some m needs are computed, and a single
+        Multiset is shared.
+
+        >>> columns = sweep_m(3, (2, 3))
+        >>> columns['m'], columns['count']
+        ([2, 2, 3, 3, 3], [2, 3, 1, 2, 3])
+        >>> columns['p'][:3]
+        [1.0, 0.25, 1.0]
+
+    """
+
+    ms = sorted(set(m_values))
+    if not (is_nonneg_int(n) and ms and
+            all(is_nonneg_int(m) and m > 0 for m in ms)):
+        print "Sweeping workers requires non-negative n and positive m."
+        raise ValueError
+    mset = Multiset(n)
+    numerators = dict((m, m ** n) for m in ms)
+    denominators = dict((m, as_denominator(numerators[m])) for m in ms)
+    lowest = dict((m, -(-n // m)) for m in ms)
+    # the row for the lowest count of each m has no ways below it
+    probs = dict((m, [truediv(numerators[m], denominators[m])]) for m in ms)
+    for bound in xrange(lowest[ms[-1]], n):
+        active = [m for m in ms if lowest[m] <= bound]
+        below = mset.bounded_ways_by_length(n, active, bound)
+        for (m, ways) in zip(active, below):
+            probs[m].append(truediv(numerators[m] - ways, denominators[m]))
+    columns = {'n': n, 'm': [], 'count': [], 'p': []}
+    for m in ms:
+        columns['m'].extend([m] * len(probs[m]))
+        columns['count'].extend(xrange(lowest[m], n + 1))
+        columns['p'].extend(probs[m])
+    return columns
+
+def log_tail_bounds(log_q, m):
+    """Return bounds on the log probability that some worker exceeds a count.
+
+    Inputs
+      :log_q: natural log of the probability q that one given worker
+              receives at least count of the top results
+      :m: number of workers
+
+    Output
+      :bounds: tuple of the natural logs of a lower and an upper bound on
+               the probability that at least one worker receives at least
+               count of the top results
+
+    Implementation
+        The union bound gives ``min(1, m * q)`` from above. From below,
+        the Bonferroni inequality gives ``m * q - C(m, 2) * q ** 2``,
+        which is tight in the tail, and because multinomial counts are
+        negatively associated ``P(no worker reaches count) <= (1 - q) ** m``
+        gives ``1 - (1 - q) ** m``, which is tight near the bulk.
+
+    """
+
+    log_upper = min(0.0, log(m) + log_q)
+    q = exp(log_q)
+    log_lower = float('-inf')
+    if (m - 1) * q < 2:
+        log_lower = log(m) + log_q + log1p(-(m - 1) * q / 2.0)
+    if q >= 1.0:
+        log_lower = 0.0
+    elif m * q > 1e-8:
+        log_lower = max(log_lower, log(-expm1(m * log1p(-q))))
+    return min(log_lower, log_upper), log_upper
+
+def compute_log_probabilities(n, m, t=()):
+    """Compute approximate probability that a result is missed, in log space.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of non-negative integers to sum to n (e.g., number of
+          workers, each returning an integer number of results)
+      :t: optional threshold to short-circuit computation
+          * integer t is the maximum number of results to return per worker
+
+    Output
+      :stats: dict containing the fields of compute_probabilities() and:
+          * log_p is the natural log of p (finite even when p underflows)
+          * rel_err bounds the relative error of p
+
+    Notes
+      The probability q(count) that one given worker receives at least
+      count results is a binomial tail, accumulated from the largest count
+      downward with log-sum-exp over terms built from
+      Multiset.log_factorial(), so nothing overflows and the whole table
+      costs O(n) floating point operations. p is the midpoint of the
+      bounds from log_tail_bounds(), and rel_err is their half-width
+      relative to p plus an allowance for rounding of the logarithms.
+      The bounds are tight for small p (high-confidence settings) and
+      loose near the bulk of the distribution.
+
+      >>> for stats in compute_log_probabilities(5, 2):
+      ...     print '%(count)d %(p)0.4f %(rel_err)0.4f' % stats
+      3 1.0000 0.0000
+      4 0.3574 0.0492
+      5 0.0620 0.0079
+
+    """
+
+    if not is_nonneg_int(t):
+        t = ()
+    for param in (n, m):
+        if not is_nonneg_int(param) or m == 0:
+            print "Log probabilities require non-negative n and positive m."
+            raise ValueError
+    lowest = -(-n // m)
+    stats = {'n': n, 'm': m, 'count': lowest, 'p': 1.0, 'log_p': 0.0,
+             'rel_err': 0.0}
+    if lowest <= t:
+        yield stats.copy()
+    if m == 1:
+        raise StopIteration
+    mset = Multiset()
+    log_fact_n = mset.log_factorial(n)
+    log_other = log(m - 1)
+    log_all = n * log(m)
+    # each log term sums values no larger than these, and each of the
+    # n accumulation steps rounds once more
+    rounding = 4 * EPSILON * (3 * log_fact_n + 2 * log_all + n + 1)
+    log_q = float('-inf')
+    tails = []
+    for cnt in xrange(n, lowest, -1):
+        term = (log_fact_n - mset.log_factorial(cnt) -
+                mset.log_factorial(n - cnt) + (n - cnt) * log_other - log_all)
+        high = max(log_q, term)
+        log_q = high + log1p(exp(min(log_q, term) - high))
+        tails.append(log_q)
+    for cnt in xrange(lowest + 1, min(n, t) + 1):
+        (log_lower, log_upper) = log_tail_bounds(tails[n - cnt], m)
+        ratio = exp(log_lower - log_upper)
+        stats['count'] = cnt
+        stats['log_p'] = log_upper + log1p(ratio) - log(2.0)
+        stats['p'] = exp(stats['log_p'])
+        stats['rel_err'] = (1.0 - ratio) / (1.0 + ratio) + rounding
+        yield stats.copy()
+
+def log_binomial_tail(mset, n, m, count):
+    """Return log probability that one worker receives count or more results.
+
+    Inputs
+      :mset: Multiset instance whose log factorial cache is used
+      :n: total number of highest scoring results
+      :m: number of workers, at least 2
+      :count: smallest number of results counted
+
+    Output
+      :log_q: natural log of the binomial tail ``P(B >= count)`` for
+              ``B ~ Binomial(n, 1 / m)``, with relative error in q of at
+              most a few units of EPSILON per term summed
+
+    Implementation
+        Terms are summed upward from count until the remaining terms,
+        bounded by a geometric series once consecutive terms decrease,
+        can no longer change the sum, so tail counts need only a few
+        dozen terms.
+
+    """
+
+    log_fact_n = mset.log_factorial(n)
+    log_other = log(m - 1)
+    log_all = n * log(m)
+    log_q = float('-inf')
+    for cnt in xrange(count, n + 1):
+        term = (log_fact_n - mset.log_factorial(cnt) -
+                mset.log_factorial(n - cnt) + (n - cnt) * log_other - log_all)
+        high = max(log_q, term)
+        log_q = high + log1p(exp(min(log_q, term) - high))
+        ratio = (n - cnt) / ((cnt + 1.0) * (m - 1))
+        if ratio == 0:
+            break
+        if ratio < 1 and term + log(ratio / (1 - ratio)) < log_q + LOG_EPSILON:
+            break
+    return log_q
+
+def normal_quantile(prob):
+    """Return x such that a standard normal variable is below x with prob."""
+    if not 0 < prob < 1:
+        print "Normal quantiles require a probability between 0 and 1."
+        raise ValueError
+    (low, high) = (-40.0, 40.0)
+    for ix in xrange(100):
+        mid = (low + high) / 2
+        if 0.5 * (1 + erf(mid / sqrt(2))) < prob:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+def compute_sampled_probabilities(n, m, t=(), precision=0.01,
+                                  confidence=0.95, seed=None,
+                                  max_samples=10 ** 7, batch_size=None):
+    """Estimate probability that a result is missed by random sampling.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of workers
+      :t: optional threshold; only rows with count at most t are yielded,
+          and only they need reach the precision
+      :precision: stop once the half-width of every confidence interval
+                  is at most precision
+      :confidence: probability that each interval covers the exact p
+      :seed: optional seed of numpy.random.RandomState, for reproducible
+             estimates
+      :max_samples: stop after this many samples even if imprecise
+      :batch_size: largest number of samples drawn at once (default: as
+                   many as fit in about 2 ** 22 loads); batches start
+                   at 1024 samples and double, so that a coarse precision
+                   stops early
+
+    Output
+      :stats: dict containing the fields of compute_probabilities(), in
+              ascending order of count through one past the largest load
+              seen (whose p estimate is 0), and:
+          * p_low and p_high bound the Wilson score interval for p
+          * samples is the number of samples drawn
+
+    Notes
+      Each sample draws the loads of all m workers from the multinomial
+      distribution at once, so the cost is proportional to m rather than
+      n per sample; for n=10000 and m=1000 a precision of 0.01 takes a
+      few seconds.
+
+      The Wilson intervals hold for each row separately, not for all
+      rows at once: with many rows, some are expected to miss the exact
+      p, so a bound on every row calls for a higher confidence.
+
+    Exceptions
+      raises ImportError when numpy is not installed, and ValueError for
+      invalid arguments, including max_samples or batch_size below 1
+
+    """
+
+    if numpy is None:
+        raise ImportError("compute_sampled_probabilities() requires numpy")
+    if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+        print "Sampling requires non-negative n and positive m."
+        raise ValueError
+    if not (precision > 0 and 0 < confidence < 1):
+        print "Sampling requires positive precision and 0 < confidence < 1."
+        raise ValueError
+    if not (is_nonneg_int(max_samples) and max_samples >= 1 and
+            (batch_size is None or
+             is_nonneg_int(batch_size) and batch_size >= 1)):
+        print "Sampling requires max_samples and batch_size of at least 1."
+        raise ValueError
+    if not is_nonneg_int(t):
+        t = n
+    lowest = -(-n // m)
+    top = min(t, n)
+    if top < lowest:
+        # as compute_probabilities(), no row has a count at most t
+        raise StopIteration
+    if batch_size is None:
+        batch_size = max(1, 2 ** 22 // m)
+    z = normal_quantile(0.5 + confidence / 2.0)
+    rand = numpy.random.RandomState(seed)
+    pvals = [1.0 / m] * m
+    hist = numpy.zeros(n + 2, dtype=numpy.int64)
+    samples = 0
+    size = 1024
+    while True:
+        size = min(size, batch_size, max_samples - samples)
+        loads = rand.multinomial(n, pvals, size=size)
+        hist += numpy.bincount(loads.max(axis=1), minlength=n + 2)
+        samples += size
+        # tail[k] is the number of samples whose largest load is at least k
+        tail = hist[::-1].cumsum()[::-1]
+        last = min(top, int(numpy.nonzero(hist)[0][-1]) + 1)
+        p = tail[lowest:last + 1] / float(samples)
+        scale = 1 + z * z / samples
+        center = (p + z * z / (2.0 * samples)) / scale
+        half = z * numpy.sqrt(p * (1 - p) / samples +
+                              z * z / (4.0 * samples * samples)) / scale
+        if half.max() <= precision or samples >= max_samples:
+            break
+        size *= 2
+    for (ix, count) in enumerate(xrange(lowest, last + 1)):
+        yield {'n': n, 'm': m, 'count': count, 'p': float(p[ix]),
+               'p_low': max(0.0, float(center[ix] - half[ix])),
+               'p_high': min(1.0, float(center[ix] + half[ix])),
+               'samples': samples}
+
+# predicted seconds per unit of work for each strategy, measured on one core
+COST_MODEL = {
+    'mset': 3.2e-6,             # multiset weighed by the 'enumerate' engine
+    'mset_bits': 2.3e-13,       # ... times the squared bits of n!
+    'numpy_mset': 3.0e-6,       # multiset weighed by the 'numpy' engine
+    'numpy_mset_bits': 4.0e-13, # ... times the squared bits of n!
+    'dp_op': 2e-8,              # 64-bit word of a 'dp' big integer update
+    'log_row': 1e-5,            # row of compute_log_probabilities()
+    'sample': 3e-7,             # sample of compute_sampled_probabilities()
+    'sample_worker': 5e-8,      # ... for each worker
+    'pool': 0.1,                # starting a process pool
+}
+
+def _log_num_uniq_msets(n, m):
+    """Return the natural log of Multiset.num_uniq_msets(n, m), roughly.
+
+    Small cases are counted exactly, in a temporary rolling
+    PartitionTable (at most ``min(m, n)`` parts are possible), so an
+    estimate never grows the shared table. Otherwise the smaller of the
+    Hardy-Ramanujan estimate of all partitions of n and the number of
+    ordered sequences ``C(n + m - 1, m - 1)``, each an upper bound, is
+    used.
+
+    """
+
+    parts = min(m, n)
+    if n * parts <= 2 * 10 ** 5:
+        return log(PartitionTable(n, parts, rolling=True).count(n, parts))
+    mset = Multiset()
+    hardy = pi * sqrt(2 * n / 3.0) - log(4 * n * sqrt(3))
+    ordered = (mset.log_factorial(n + m - 1) - mset.log_factorial(n) -
+               mset.log_factorial(m - 1))
+    return min(hardy, ordered)
+
+def explain(n, m, t=(), precision=None, processes=None):
+    """Predict the cost of each strategy for compute_probabilities().
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of workers
+      :t: optional threshold, as for compute_probabilities()
+      :precision: optional largest acceptable absolute error of p, which
+                  makes the approximate strategies 'log' and 'sample'
+                  eligible; None requires exact values
+      :processes: optional number of worker processes for 'enumerate'
+
+    Output
+      :plan: dict containing fields:
+          * engine is the cheapest eligible strategy
+          * cost is its predicted run time in seconds
+          * exact is False for an approximate strategy
+          * costs maps every eligible strategy to its predicted seconds
+          * order lists the eligible strategies from cheapest
+
+    Notes
+      Predictions come from COST_MODEL: 'enumerate' and 'numpy' scale
+      with the number of multisets (Multiset.num_uniq_msets()) times a
+      cost that grows with the square of the bits of n!, 'dp' with
+      its big integer updates up to t, 'log' with the number of rows and
+      'sample' with the samples needed for a 95% interval of half-width
+      precision at p = 0.5. The 'log' bounds are only known after it
+      runs, so compute_probabilities() checks them and moves on to the
+      next strategy when they are too wide.
+
+      >>> plan = explain(1000, 64)
+      >>> plan['engine'], plan['exact']
+      ('dp', True)
+      >>> explain(10000, 1000, precision=0.01)['engine']
+      'log'
+
+    """
+
+    if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+        print "Planning requires non-negative n and positive m."
+        raise ValueError
+    top = min(t, n) if is_nonneg_int(t) else n
+    lowest = -(-n // m)
+    costs = {}
+    log_msets = _log_num_uniq_msets(n, m)
+    # cap the exponent; beyond it enumeration is hopeless in any case
+    msets = exp(min(log_msets, 600.0))
+    # weights are products of factorials, so big integer products dominate
+    bits = Multiset().log_factorial(n) / log(2)
+    per_mset = COST_MODEL['mset'] + bits ** 2 * COST_MODEL['mset_bits']
+    if processes is None:
+        costs['enumerate'] = msets * per_mset
+    else:
+        costs['enumerate'] = (msets * per_mset / max(processes, 1) +
+                              COST_MODEL['pool'])
+    if numpy is not None:
+        costs['numpy'] = msets * (COST_MODEL['numpy_mset'] +
+                                  bits ** 2 * COST_MODEL['numpy_mset_bits'])
+    # bound b fills about n - k * (b + 1) entries for each k < m
+    ops = 0
+    for bound in xrange(max(lowest - 1, 0), top):
+        rows = min(m, -(-n // (bound + 1)))
+        ops += rows * n - (bound + 1) * rows * (rows - 1) // 2
+    words = 1 + n * log(m, 2) / 64 if m > 1 else 1
+    costs['dp'] = ops * words * COST_MODEL['dp_op']
+    if precision is not None:
+        costs['log'] = (top - lowest + 1) * COST_MODEL['log_row']
+        if numpy is not None:
+            samples = (1.96 / (2.0 * precision)) ** 2
+            costs['sample'] = samples * (COST_MODEL['sample'] +
+                                         m * COST_MODEL['sample_worker'])
+    order = sorted(costs, key=lambda name: (costs[name], name))
+    return {'engine': order[0], 'cost': costs[order[0]],
+            'exact': order[0] in ENGINES, 'costs': costs, 'order': order}
+
+def solve_k(n, m, epsilon, exact=True):
+    """Return smallest per-worker count that misses with odds below epsilon.
+
+    Inputs
+      :n: total number (e.g., total number of highest scoring results)
+      :m: number of workers
+      :epsilon: largest acceptable probability that a top result is missed
+      :exact: if False, never fall back to exact big integer arithmetic
+              and return the smallest k proven sufficient by the bounds
+
+    Output
+      :k: smallest k for which the probability that some worker holds
+          more than k of the top n results is below epsilon (i.e., the
+          ``count - 1`` of the first row of compute_probabilities() whose
+          p is below epsilon)
+
+    Exceptions
+      raises ValueError for inputs that are not positive
+
+    Implementation
+        Bisects on k. At each k, log_binomial_tail() and log_tail_bounds()
+        bracket the probability in microseconds, and only when epsilon
+        falls inside that bracket is the exact answer computed with
+        Multiset.num_ways_bounded(). In the tail the bracket is narrow,
+        so the exact step is rarely needed.
+
+        >>> solve_k(100, 10, 0.01)
+        20
+        >>> solve_k(5, 2, 0.375)
+        4
+
+    """
+
+    for param in (n, m):
+        if not is_nonneg_int(param) or m == 0 or not epsilon > 0:
+            print "Solving for k requires positive m and epsilon."
+            raise ValueError
+    if epsilon > 1:
+        return 0
+    mset = Multiset()
+    target = Fraction(epsilon)
+
+    def sufficient(k):
+        """Return True if P(a worker holds more than k) < epsilon."""
+        if m > 1:
+            log_q = log_binomial_tail(mset, n, m, k + 1)
+            (log_lower, log_upper) = log_tail_bounds(log_q, m)
+            if exp(log_upper) * (1 + BOUND_SLACK) < epsilon:
+                return True
+            if exp(log_lower) * (1 - BOUND_SLACK) >= epsilon or not exact:
+                return False
+        total = m ** n
+        missed = total - mset.num_ways_bounded(n, m, k)
+        return missed * target.denominator < target.numerator * total
+
+    (low, high) = (-(-n // m) - 1, n)  # low never suffices, high always does
+    while high - low > 1:
+        mid = (low + high) // 2
+        if sufficient(mid):
+            high = mid
+        else:
+            low = mid
+    return high
+
+class ProbabilityCache(object):
+
+    """Persistent cache of probability tables keyed by (n, m).
+
+    Tables from compute_all_probabilities() are kept in one binary file,
+    which is memory-mapped for lookups, so a restarted process answers
+    repeated queries without recomputation and only pages in the tables
+    that it reads. The layout (all little-endian) is::
+
+        header  magic 'PMSC', version, number of tables, access clock
+        index   (n, m, first count, rows, data offset, last access) for
+                each table, sorted by (n, m)
+        data    float64 p for each row of each table
+
+    Lookups bisect the index and update the table's last access in place.
+    Storing a table rewrites the file atomically (see _atomic_write()),
+    first evicting least recently used tables until the file fits within
+    max_bytes. A table larger than max_bytes is returned but not stored.
+
+    Processes sharing the file serialize updates with fcntl.flock() on
+    ``path + '.lock'``, so that no stored table is lost (an access that
+    races with a rewrite may be); where fcntl is unavailable, only one
+    process may write the cache. A file
+    that is truncated or not a cache is ignored, and replaced by the
+    next put(). A file that cannot be written is still read, without
+    updating last accesses.
+
+    Example
+        ::
+
+            >> cache = ProbabilityCache('/var/tmp/pymsetmath.cache')
+            >> rows = list(cache.probabilities(100, 10))
+
+    """
+
+    MAGIC = 'PMSC'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIQ')
+    ENTRY = struct.Struct('<IIIIQQ')
+    VALUE = struct.Struct('<d')
+
+    def __init__(self, path, max_bytes=64 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._map = None
+        self._writable = False
+        self._stamp = None
+        self._keys = []
+
+    def close(self):
+        """Release the memory map."""
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._stamp = None
+        self._keys = []
+
+    def _refresh(self):
+        """Map the cache file again if it has been replaced."""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            self.close()
+            return
+        stamp = (info.st_ino, info.st_mtime, info.st_size)
+        if stamp == self._stamp:
+            return
+        self.close()
+        # ignore the file until it changes again, unless it is valid
+        self._stamp = stamp
+        writable = os.access(self.path, os.W_OK)
+        cache_file = open(self.path, 'r+b' if writable else 'rb')
+        try:
+            mapped = mmap.mmap(cache_file.fileno(), 0, access=(
+                mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ))
+        except (ValueError, EnvironmentError):
+            mapped = None
+        finally:
+            cache_file.close()
+        keys = self._read_keys(mapped)
+        if keys is None:
+            if mapped is not None:
+                mapped.close()
+            print "Ignoring unrecognized cache file %s." % self.path
+            return
+        self._map = mapped
+        self._writable = writable
+        self._keys = keys
+
+    def _read_keys(self, mapped):
+        """Return the (n, m) of each table of a mapped file, or None.
+
+        None means that the file is not a complete cache file, such as
+        an empty or truncated file.
+
+        """
+
+        if mapped is None or len(mapped) < self.HEADER.size:
+            return None
+        (magic, version, count, clock) = self.HEADER.unpack_from(mapped, 0)
+        if (magic != self.MAGIC or version != self.VERSION or
+                self.HEADER.size + count * self.ENTRY.size > len(mapped)):
+            return None
+        keys = []
+        for ix in xrange(count):
+            entry = self.ENTRY.unpack_from(
+                mapped, self.HEADER.size + ix * self.ENTRY.size)
+            if entry[4] + entry[3] * self.VALUE.size > len(mapped):
+                return None
+            keys.append(entry[:2])
+        return keys
+
+    def _lock(self):
+        """Return the locked lock file of the cache, or None without one."""
+        if fcntl is None:
+            return None
+        try:
+            lock_file = open(self.path + '.lock', 'a')
+        except IOError:
+            return None
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def _unlock(self, lock_file):
+        """Release a lock file returned by _lock()."""
+        if lock_file is not None:
+            lock_file.close()
+
+    def _entries(self):
+        """Return a list of (entry, p values) for every cached table."""
+        result = []
+        for ix in xrange(len(self._keys)):
+            entry = self.ENTRY.unpack_from(
+                self._map, self.HEADER.size + ix * self.ENTRY.size)
+            (offset, rows) = (entry[4], entry[3])
+            values = struct.unpack_from('<%dd' % rows, self._map, offset)
+            result.append((entry, values))
+        return result
+
+    def get(self, n, m):
+        """Return the cached rows for (n, m) as a list, or None."""
+        self._refresh()
+        ix = bisect_left(self._keys, (n, m))
+        if ix == len(self._keys) or self._keys[ix] != (n, m):
+            return None
+        position = self.HEADER.size + ix * self.ENTRY.size
+        (n, m, first, rows, offset, used) = self.ENTRY.unpack_from(
+            self._map, position)
+        values = struct.unpack_from('<%dd' % rows, self._map, offset)
+        if self._writable:
+            lock_file = self._lock()
+            try:
+                clock = self.HEADER.unpack_from(self._map, 0)[3] + 1
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION,
+                                      len(self._keys), clock)
+                self.ENTRY.pack_into(self._map, position, n, m, first, rows,
+                                     offset, clock)
+            finally:
+                self._unlock(lock_file)
+        return [{'n': n, 'm': m, 'count': first + ix, 'p': p}
+                for (ix, p) in enumerate(values)]
+
+    def put(self, n, m, rows):
+        """Store rows from compute_all_probabilities(n, m) in the cache."""
+        rows = list(rows)
+        size = (self.HEADER.size + self.ENTRY.size +
+                self.VALUE.size * len(rows))
+        if size > self.max_bytes or not rows:
+            return
+        lock_file = self._lock()
+        try:
+            self._put(n, m, rows)
+        finally:
+            self._unlock(lock_file)
+
+    def _put(self, n, m, rows):
+        """Rewrite the cache file with rows added, holding the lock."""
+        self._refresh()
+        clock = 0
+        tables = []
+        if self._map is not None:
+            clock = self.HEADER.unpack_from(self._map, 0)[3]
+            tables = [pair for pair in self._entries()
+                      if pair[0][:2] != (n, m)]
+        clock += 1
+        tables.append(((n, m, rows[0]['count'], len(rows), 0, clock),
+                       [stats['p'] for stats in rows]))
+        # evict least recently used tables until the new file fits
+        tables.sort(key=lambda pair: pair[0][5], reverse=True)
+        while True:
+            size = self.HEADER.size + sum(
+                self.ENTRY.size + self.VALUE.size * len(values)
+                for (entry, values) in tables)
+            if size <= self.max_bytes:
+                break
+            tables.pop()
+        tables.sort()
+        offset = self.HEADER.size + self.ENTRY.size * len(tables)
+        chunks = [self.HEADER.pack(self.MAGIC, self.VERSION, len(tables),
+                                   clock)]
+        for (entry, values) in tables:
+            chunks.append(self.ENTRY.pack(*(entry[:4] + (offset, entry[5]))))
+            offset += self.VALUE.size * len(values)
+        for (entry, values) in tables:
+            chunks.append(struct.pack('<%dd' % len(values), *values))
+        self.close()
+        _atomic_write(self.path, ''.join(chunks))
+
+    def probabilities(self, n, m, engine='dp'):
+        """Return rows of compute_all_probabilities(), computing on a miss."""
+        rows = self.get(n, m)
+        if rows is None:
+            rows = list(compute_all_probabilities(n, m, engine))
+            self.put(n, m, rows)
+        return rows
+
+class _TableIndex(object):
+    """Sequence of the (n, m) keys of a mapped ProbabilityTable."""
+
+    def __init__(self, mapped, count):
+        self._map = mapped
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, ix):
+        return ProbabilityTable.ENTRY.unpack_from(
+            self._map, ProbabilityTable.HEADER.size +
+            ix * ProbabilityTable.ENTRY.size)[:2]
+
+class ProbabilityTable(object):
+
+    """Read-only, memory-mapped probability tables for many (n, m).
+
+    The file written by build_table() holds, for each (n, m) of a grid,
+    the p of every row of compute_all_probabilities(n, m) as float64.
+    The layout (all little-endian, with data aligned to 8 bytes) is::
+
+        header  magic 'PMST', version, number of tables
+        index   (n, m, first count, rows, data offset) for each table,
+                sorted by (n, m)
+        data    float64 p for each row of each table
+
+    Nothing is read when the file is opened. Each lookup bisects the
+    index and then the rows of one table in place, reading O(log)
+    entries, so a table of any size is served from the page cache and
+    shared between processes. Values agree with the exact functions to
+    float64 rounding (e.g., min_k() and solve_k() may differ when
+    epsilon equals a p to within rounding).
+
+    Example
+        ::
+
+            >> build_table('/var/tmp/pymsetmath.table',
+            ..             [(n, m) for n in xrange(1, 1001)
+            ..              for m in (2, 4, 8, 16, 32, 64)])
+            >> table = ProbabilityTable('/var/tmp/pymsetmath.table')
+            >> table.p(100, 10, 20), table.min_k(100, 10, 0.01)
+
+    """
+
+    MAGIC = 'PMST'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQ')
+    ENTRY = struct.Struct('<IIIIQ')
+    VALUE = struct.Struct('<d')
+
+    def __init__(self, path):
+        self.path = path
+        table_file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(table_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        finally:
+            table_file.close()
+        (magic, version, count) = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self._map.close()
+            print "Unrecognized probability table %s." % path
+            raise ValueError
+        self._keys = _TableIndex(self._map, count)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        ix = bisect_left(self._keys, key)
+        return ix < len(self._keys) and self._keys[ix] == key
+
+    def close(self):
+        """Release the memory map."""
+        self._map.close()
+
+    def _entry(self, n, m):
+        """Return (first count, rows, data offset) of the table for (n, m)."""
+        ix = bisect_left(self._keys, (n, m))
+        if ix == len(self._keys) or self._keys[ix] != (n, m):
+            raise KeyError((n, m))
+        return self.ENTRY.unpack_from(
+            self._map, self.HEADER.size + ix * self.ENTRY.size)[2:]
+
+    def p(self, n, m, k):
+        """Return the probability that some worker holds more than k results.
+
+        This is the p of the row of compute_all_probabilities(n, m) whose
+        count is k + 1 (1.0 below the first row, 0.0 for k >= n). Raises
+        KeyError when (n, m) is not in the table.
+
+        """
+
+        (first, rows, offset) = self._entry(n, m)
+        ix = k + 1 - first
+        if ix < 0:
+            return 1.0
+        if ix >= rows:
+            return 0.0
+        return self.VALUE.unpack_from(self._map,
+                                      offset + ix * self.VALUE.size)[0]
+
+    def min_k(self, n, m, epsilon):
+        """Return the smallest k for which p(n, m, k) is below epsilon.
+
+        Matches solve_k(n, m, epsilon), by bisecting the non-increasing
+        p of the table. Raises KeyError when (n, m) is not in the table.
+
+        """
+
+        (first, rows, offset) = self._entry(n, m)
+        if epsilon > 1:
+            return 0
+        (low, high) = (0, rows)
+        while low < high:
+            mid = (low + high) // 2
+            value = self.VALUE.unpack_from(self._map,
+                                           offset + mid * self.VALUE.size)[0]
+            if value < epsilon:
+                high = mid
+            else:
+                low = mid + 1
+        return first + low - 1
+
+    def values(self, n, m):
+        """Return the p of every row for (n, m), as in the file.
+
+        With numpy, the result is a read-only array backed by the memory
+        map rather than a copy; otherwise it is a tuple of floats.
+
+        """
+
+        (first, rows, offset) = self._entry(n, m)
+        if numpy is not None:
+            return numpy.frombuffer(self._map, '<f8', rows, offset)
+        return struct.unpack_from('<%dd' % rows, self._map, offset)
+
+def build_table(path, grid):
+    """Write the probability tables of every (n, m) of grid to one file.
+
+    Inputs
+      :path: file to write, atomically (see _atomic_write()), for
+             ProbabilityTable
+      :grid: iterable of (n, m) pairs; duplicates are written once
+
+    Output
+      :count: number of tables written
+
+    Implementation
+        Pairs are grouped by n, and all the m of one n are computed in a
+        single pass by sweep_m(), whose values are identical to those of
+        compute_all_probabilities(n, m, engine='dp').
+
+    """
+
+    by_n = defaultdict(set)
+    for (n, m) in grid:
+        if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+            print "Tables require non-negative n and positive m."
+            raise ValueError
+        by_n[int(n)].add(int(m))
+    index = []
+    data = []
+    for n in sorted(by_n):
+        columns = sweep_m(n, by_n[n])
+        start = 0
+        for (m, group) in groupby(columns['m']):
+            rows = len(list(group))
+            index.append((n, m, columns['count'][start], rows))
+            data.append(struct.pack('<%dd' % rows,
+                                    *columns['p'][start:start + rows]))
+            start += rows
+    layout = ProbabilityTable
+    offset = layout.HEADER.size + layout.ENTRY.size * len(index)
+    chunks = [layout.HEADER.pack(layout.MAGIC, layout.VERSION, len(index))]
+    for ((n, m, first, rows), values) in zip(index, data):
+        chunks.append(layout.ENTRY.pack(n, m, first, rows, offset))
+        offset += len(values)
+    _atomic_write(path, ''.join(chunks + data))
+    return len(index)
+
 def print_cumulative_prob(n=1, m=1, digits=4):
     """Given a number of top results n and a number of nodes m print odds.
 
@@ -235,8 +1606,11 @@ requested per worker.""" % (mset.num_uniq_msets(total=n1, length=m1),
     num_docs = 20
     num_ms = mset.num_uniq_msets(total=n2, length=m2)
     print 'computing longer example, involving %d multisets ...' % num_ms
+    instrument = Instrument(progress=lambda inst: sys.stderr.write(
+        inst.summary() + '\n'))
     # add one because result is omitted only when set size exceeds request
-    for stats in compute_probabilities(n=n2, m=m2, t=num_docs + 1):
+    for stats in compute_probabilities(n=n2, m=m2, t=num_docs + 1,
+                                       instrument=instrument):
         if stats['count'] == num_docs + 1:
             print ' '.join(['Longer example\nChance of omitting documents',
                 'from top %d when returning %d results\nfrom each of',
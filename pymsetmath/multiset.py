@@ -6,9 +6,24 @@
 
 __docformat__ = 'restructuredtext'
 
-from collections import defaultdict
-from itertools import groupby
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, deque, OrderedDict
+from itertools import chain, groupby, imap, islice
+from math import lgamma
+from multiprocessing import Pool
+import json
 from operator import itemgetter
+import os
+from sys import getsizeof
+import tempfile
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def is_nonneg_int(number):
     """Return True for a non-negative integer."""
@@ -18,44 +33,683 @@ def is_nonneg_int(number):
     except TypeError:
         return False
 
+def _atomic_write(path, data):
+    """Replace the file at path with data, so readers never see a partial file.
+
+    The data is written and flushed to a temporary file in the same
+    directory, which is then renamed over path.
+
+    """
+
+    (handle, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                          prefix='.tmp-')
+    try:
+        tmp_file = os.fdopen(handle, 'wb')
+        try:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        finally:
+            tmp_file.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def _prefixes(total, length, depth, bound):
+    """Yield the distinct leading elements of non-ascending sequences.
+
+    Yields, in lexicographic order, the first ``depth`` elements (or all
+    of them, for shorter sequences) of every non-ascending sequence of
+    ``length`` non-negative integers that sums to total and whose first
+    element is at most bound.
+
+    """
+
+    if depth == 0:
+        yield ()
+    elif length == 0:
+        if total == 0:
+            yield ()
+    else:
+        for val in xrange(-(-total // length), min(bound, total) + 1):
+            for rest in _prefixes(total - val, length - 1, depth - 1, val):
+                yield (val,) + rest
+
+class _BoxSeries(object):
+    """Counts of the partitions that fit in a box, for every sum.
+
+    counts[s] is the number of non-ascending sequences of length
+    non-negative integers that sum to s with every element at most
+    bound, for s up to total: the coefficients of the Gaussian binomial
+
+        [length + bound, length] = prod((1 - q ** (bound + i)) /
+                                        (1 - q ** i) for i in 1..length)
+
+    truncated after q ** total. resize() moves to another box by the
+    factors that differ, each in O(total) operations, so a walk that
+    changes the box a little at a time keeps only total + 1 counts.
+
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.length = 0
+        self.bound = 0
+        self.counts = [1] + [0] * total
+
+    def _times(self, power, inverse):
+        """Multiply counts by (1 - q ** power), or divide by it."""
+        counts = self.counts
+        if power > self.total:
+            return
+        if inverse:
+            for s in xrange(power, self.total + 1):
+                counts[s] += counts[s - power]
+        else:
+            for s in xrange(self.total, power - 1, -1):
+                counts[s] -= counts[s - power]
+
+    def resize(self, length, bound):
+        """Change the box to length by bound."""
+        while self.bound < bound:
+            self.bound += 1
+            self._times(self.bound + self.length, False)
+            self._times(self.bound, True)
+        while self.bound > bound:
+            self._times(self.bound + self.length, True)
+            self._times(self.bound, False)
+            self.bound -= 1
+        while self.length < length:
+            self.length += 1
+            self._times(self.bound + self.length, False)
+            self._times(self.length, True)
+        while self.length > length:
+            self._times(self.bound + self.length, True)
+            self._times(self.length, False)
+            self.length -= 1
+
+def _num_ways_for_prefixes(args):
+    """Return the number of ways and of multisets for some prefixes.
+
+    Runs in a worker process for Multiset.num_ways(), so it accepts a
+    single picklable tuple ``(total, length, prefixes)``, and sums over
+    the multisets that start with any of the prefixes.
+
+    """
+
+    (total, length, prefixes) = args
+    mset = Multiset(total)
+    ways = visited = 0
+    for prefix in prefixes:
+        for (grp, weight) in mset._msets_with_prefix(total, length, prefix):
+            ways += weight
+            visited += 1
+    return ways, visited
+
+_PRIMES = []
+_PRIME_LIMIT = 1
+
+def primes_upto(limit):
+    """Return a list of the primes up to limit, from a cached sieve.
+
+    The sieve grows at least twofold whenever a larger limit is needed.
+
+    """
+
+    global _PRIMES, _PRIME_LIMIT
+    if limit > _PRIME_LIMIT:
+        size = max(limit, 2 * _PRIME_LIMIT)
+        sieve = bytearray([1]) * (size + 1)
+        sieve[0:2] = bytearray(2)
+        for val in xrange(2, int(size ** 0.5) + 1):
+            if sieve[val]:
+                sieve[val * val::val] = bytearray(
+                    len(xrange(val * val, size + 1, val)))
+        _PRIMES = [val for val in xrange(size + 1) if sieve[val]]
+        _PRIME_LIMIT = size
+    primes = _PRIMES
+    return primes[:bisect_right(primes, limit)]
+
+def _legendre(n, p):
+    """Return the exponent of the prime p in n!."""
+    exp = 0
+    while n:
+        n //= p
+        exp += n
+    return exp
+
+def _product(values, lo=0, hi=None):
+    """Return the product of values[lo:hi] from a balanced product tree."""
+    if hi is None:
+        hi = len(values)
+    if hi - lo <= 8:
+        result = 1
+        for ix in xrange(lo, hi):
+            result *= values[ix]
+        return result
+    mid = (lo + hi) // 2
+    return _product(values, lo, mid) * _product(values, mid, hi)
+
+def multinomial_from_primes(values):
+    """Return the multinomial coefficient of values from prime exponents.
+
+    Inputs
+      :values: sequence of non-negative integers
+
+    Implementation
+        By Legendre's formula the exponent of a prime p in ``n!`` is
+        ``n // p + n // p ** 2 + ...``, so the exponent of p in the
+        coefficient is that of the total less those of the values (only
+        values of at least p contribute, and a single term suffices once
+        ``p * p`` exceeds the total). The coefficient is then assembled
+        from the binary digits of the exponents, squaring a running
+        result once per digit and multiplying in the product tree of the
+        primes whose exponent has that digit set, so no factorial is
+        ever formed or divided.
+
+    """
+
+    total = sum(values)
+    vals = sorted((val for val in values if val > 1), reverse=True)
+    primes = primes_upto(total)
+    pairs = []
+    size = len(vals)
+    for p in primes:
+        while size and vals[size - 1] < p:
+            size -= 1
+        if p * p > total:
+            exp = total // p
+            for ix in xrange(size):
+                exp -= vals[ix] // p
+        else:
+            exp = _legendre(total, p)
+            for ix in xrange(size):
+                exp -= _legendre(vals[ix], p)
+        if exp:
+            pairs.append((p, exp))
+    result = 1
+    if pairs:
+        for bit in reversed(xrange(max(exp for (p, exp) in pairs)
+                                   .bit_length())):
+            result *= result
+            result *= _product([p for (p, exp) in pairs if exp >> bit & 1])
+    return result
+
+class Instrument(object):
+
+    """Collect counters and timings and report progress for a Multiset.
+
+    Pass an instance as ``Multiset(instrument=...)`` (or to the generators
+    of pymsetmath.examples); a Multiset without one runs no instrumentation
+    code at all.
+
+    Counters
+      :msets: multisets visited by enumeration
+      :factorial_hits: factorials found in the cache
+      :factorial_misses: factorials that first extended the cache
+
+    Times (seconds)
+      :enumerate: stepping from one multiset to the next
+      :weight: updating weights (weighted_msets(), num_ways())
+
+    Progress
+      Each enumeration adds Multiset.num_uniq_msets() for its sum and
+      length to total. Every interval seconds (checked each
+      ``Instrument.CHECK_EVERY`` multisets) progress is called with the
+      instrument, whose summary() includes an estimated time remaining::
+
+          >> instrument = Instrument(lambda inst: sys.stderr.write(
+          ..     inst.summary() + '\\n'))
+          >> ways = dict(Multiset(instrument=instrument).num_ways(100, 10))
+
+    """
+
+    CHECK_EVERY = 4096
+
+    def __init__(self, progress=None, interval=5.0):
+        self.counters = defaultdict(int)
+        self.times = defaultdict(float)
+        self.total = 0
+        self.started = None
+        self.progress = progress
+        self.interval = interval
+        self._next_report = None
+
+    def begin(self, total):
+        """Add an enumeration of total multisets to the expected work."""
+        if self.started is None:
+            self.started = time.time()
+            self._next_report = self.started + self.interval
+        self.total += total
+
+    def add(self, count):
+        """Record count multisets visited elsewhere (e.g., in a worker)."""
+        self.counters['msets'] += count
+        self.poll()
+
+    def poll(self):
+        """Call progress if at least interval seconds have passed."""
+        if self.progress is not None and time.time() >= self._next_report:
+            self._next_report = time.time() + self.interval
+            self.progress(self)
+
+    def elapsed(self):
+        """Return seconds since the first enumeration began."""
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def eta(self):
+        """Return estimated seconds remaining, or None before any visit."""
+        done = self.counters['msets']
+        if not done:
+            return None
+        return self.elapsed() * max(self.total - done, 0) / float(done)
+
+    def summary(self):
+        """Return a one-line description of progress and timings."""
+        done = self.counters['msets']
+        eta = self.eta()
+        return ('visited %d of %d multisets (%.1f%%) in %.1f s, eta %s; '
+                'enumerate %.1f s, weight %.1f s; factorial hits %d, '
+                'misses %d') % (
+            done, self.total, 100.0 * done / max(self.total, 1),
+            self.elapsed(), 'unknown' if eta is None else '%.0f s' % eta,
+            self.times['enumerate'], self.times['weight'],
+            self.counters['factorial_hits'],
+            self.counters['factorial_misses'])
+
+    def visit(self, walk):
+        """Yield from walk, counting items and timing each step."""
+        counters = self.counters
+        times = self.times
+        clock = time.time
+        walk = iter(walk)
+        check = self.CHECK_EVERY
+        while True:
+            start = clock()
+            try:
+                item = walk.next()
+            except StopIteration:
+                break
+            times['enumerate'] += clock() - start
+            counters['msets'] += 1
+            if not counters['msets'] % check:
+                self.poll()
+            yield item
+
+    def timed(self, walk, key, exclude=None):
+        """Yield from walk, adding the time of each step to times[key].
+
+        Time recorded under exclude during a step (e.g., the enumeration
+        nested within weighting) is not added to key.
+
+        """
+
+        times = self.times
+        clock = time.time
+        walk = iter(walk)
+        while True:
+            start = clock()
+            inner = times[exclude]
+            try:
+                item = walk.next()
+            except StopIteration:
+                break
+            times[key] += clock() - start - (times[exclude] - inner)
+            yield item
+
+class FactorialStore(object):
+
+    """Thread-safe cache of factorials, shared by Multiset instances.
+
+    Element n of the list values is n! or None once evicted, so a cached
+    factorial costs one list lookup. A matching array of log factorials
+    (see Multiset.log_factorial()) is kept in logs.
+
+    Inputs
+      :max_bytes: approximate cap on the memory of evictable factorials,
+                  or None for no cap
+      :stride: every stride-th factorial is a checkpoint that is never
+               evicted
+
+    Implementation
+        Factorials are grouped in blocks of stride values, each starting
+        at a checkpoint. When the values computed outside checkpoints
+        exceed max_bytes, whole blocks are evicted, those computed longest
+        ago first. An evicted factorial is recomputed from the checkpoint
+        that starts its block, refilling that block only. Computing and
+        evicting take the lock and update values in place, so that
+        Multiset.factorial() can read a cached value from values without
+        taking it.
+
+    """
+
+    def __init__(self, max_bytes=None, stride=64):
+        self.values = [1]
+        self.logs = array('d', [0.0])
+        self.max_bytes = max_bytes
+        self.stride = stride
+        self.nbytes = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def cached(self, n):
+        """Return True if n! is held by the store."""
+        try:
+            return n >= 0 and self.values[n] is not None
+        except (IndexError, TypeError):
+            return False
+
+    def factorial(self, n):
+        """Return n! for a non-negative int n, computing it as needed."""
+        values = self.values
+        with self._lock:
+            if n < len(values) and values[n] is not None:
+                return values[n]
+            start = min(n, len(values) - 1)
+            while values[start] is None:
+                start -= 1
+            value = values[start]
+            stride = self.stride
+            blocks = self._blocks
+            for val in xrange(start + 1, n + 1):
+                value *= val
+                if val < len(values):
+                    values[val] = value
+                else:
+                    values.append(value)
+                if val % stride:
+                    size = getsizeof(value)
+                    block = val // stride
+                    blocks[block] = blocks.pop(block, 0) + size
+                    self.nbytes += size
+            self._evict(n // stride)
+            return value
+
+    def _evict(self, keep=None):
+        """Evict blocks computed longest ago until within max_bytes."""
+        if self.max_bytes is None:
+            return
+        values = self.values
+        blocks = self._blocks
+        stride = self.stride
+        while self.nbytes > self.max_bytes and blocks:
+            (block, size) = blocks.popitem(last=False)
+            if block == keep:
+                blocks[block] = size
+                if len(blocks) == 1:
+                    break
+                continue
+            first = block * stride + 1
+            stop = min(first + stride - 1, len(values))
+            values[first:stop] = [None] * (stop - first)
+            self.nbytes -= size
+
+    def set_max_bytes(self, max_bytes):
+        """Change the memory cap, evicting at once if it is exceeded."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def log_factorial(self, n):
+        """Return the natural log of n! for a non-negative int n."""
+        logs = self.logs
+        if n >= len(logs):
+            with self._lock:
+                logs.extend(lgamma(val + 1.0)
+                            for val in xrange(len(logs), n + 1))
+        return logs[n]
+
+    def clear(self):
+        """Discard every factorial and log factorial except 0!."""
+        with self._lock:
+            del self.values[1:]
+            del self.logs[1:]
+            self._blocks.clear()
+            self.nbytes = 0
+
+# factorials shared by every Multiset created without its own store
+FACTORIALS = FactorialStore(max_bytes=256 * 2 ** 20)
+
+class PartitionTable(object):
+
+    """Cached counts of partitions of integers into a bounded number of parts.
+
+    Element ``[i][j]`` of the table is the number of partitions of i into
+    at most j parts, which is Multiset.num_uniq_msets(i, j), so once the
+    table covers (total, length) every smaller query is one lookup. The
+    table grows on demand (see extend()) and is safe to share between
+    threads.
+
+    Inputs
+      :total: largest sum to count initially
+      :length: largest number of parts to count initially
+      :rolling: if True, keep only the last ``length + 1`` rows, which is
+                all that the recurrence needs, so memory is
+                ``O(length ** 2)``; only sums within that window can then
+                be queried, and length cannot grow
+      :max_cells: optional largest number of counts the table may hold;
+                  count() answers a query beyond it from a temporary
+                  rolling table rather than growing
+
+    Implementation
+        A partition into at most j parts either has fewer than j parts or,
+        after removing one from each of its j parts, is a partition of
+        ``i - j`` into at most j parts::
+
+            count(i, j) = count(i, j - 1) + count(i - j, j)
+
+    Example
+        ::
+
+            >>> table = PartitionTable(10, 3)
+            >>> table.count(10, 3), table.count(4, 4)
+            (14, 5)
+            >>> table.leading_counts(10, 3)
+            [0, 0, 0, 0, 2, 3, 3, 2, 2, 1, 1]
+
+    """
+
+    def __init__(self, total=0, length=0, rolling=False, max_cells=None):
+        self.rolling = rolling
+        self.max_cells = max_cells
+        self.total = 0
+        self.length = 0
+        self._rows = [[1]]
+        self._first = 0
+        self._lock = threading.RLock()
+        if rolling:
+            self._rows = deque(self._rows, length + 1)
+            self._extend_length(length)
+        self.extend(total, length)
+
+    def extend(self, total, length):
+        """Grow the table to cover sums up to total and up to length parts."""
+        with self._lock:
+            if length > self.length:
+                if self.rolling:
+                    print "A rolling partition table cannot add parts."
+                    raise ValueError
+                self._extend_length(length)
+            rows = self._rows
+            first = self._first
+            length = self.length
+            for i in xrange(self.total + 1, total + 1):
+                row = [0]
+                for j in xrange(1, length + 1):
+                    above = rows[i - j - first][j] if i >= j else 0
+                    row.append(row[-1] + above)
+                if self.rolling and len(rows) == rows.maxlen:
+                    self._first += 1
+                    first += 1
+                rows.append(row)
+                self.total = i
+
+    def _extend_length(self, length):
+        """Add columns up to length parts to every row."""
+        rows = self._rows
+        for (ix, row) in enumerate(rows):
+            for j in xrange(len(row), length + 1):
+                above = rows[ix - j][j] if ix >= j else 0
+                row.append(row[-1] + above)
+        self.length = length
+
+    def count(self, total, length):
+        """Return the number of partitions of total into at most length parts.
+
+        Equals Multiset.num_uniq_msets(total, length), extending the table
+        if needed. Because a partition of total has at most total parts,
+        length is first reduced to at most total.
+
+        """
+
+        if total < 0 or length < 0:
+            print "Partition counts require non-negative integers."
+            raise ValueError
+        length = min(length, total)
+        with self._lock:
+            if total > self.total or length > self.length:
+                (rows, columns) = (max(total, self.total),
+                                   max(length, self.length))
+                if (self.max_cells is None or
+                        (rows + 1) * (columns + 1) <= self.max_cells):
+                    self.extend(rows, columns)
+            if total <= self.total and length <= self.length:
+                if total < self._first:
+                    print ("Sum %d has left the rolling partition table." %
+                           total)
+                    raise ValueError
+                return self._rows[total - self._first][length]
+        return PartitionTable(total, length, rolling=True).count(total,
+                                                                 length)
+
+    def leading_counts(self, total, length):
+        """Return the number of multisets for each value of the largest part.
+
+        Output
+          :counts: list whose element v is the number of multisets of
+                   uniq_msets(total, length) whose first element is v, so
+                   prefix sums give the index at which each key of
+                   Multiset.num_ways() starts
+
+        Implementation
+            The count for v is the number of partitions of ``total - v``
+            into at most ``length - 1`` parts, each at most v. A
+            _BoxSeries of that length holds them for every sum, and
+            raising its bound by one per value costs O(total), so the
+            counts take ``O((length + total) * total)`` time and
+            O(total) memory, with nothing kept by the table.
+
+        """
+
+        if length == 0:
+            print "Leading part counts require a positive length."
+            raise ValueError
+        box = _BoxSeries(total)
+        box.resize(length - 1, 0)
+        counts = []
+        for val in xrange(total + 1):
+            box.resize(length - 1, val)
+            counts.append(box.counts[total - val])
+        return counts
+
+# partition counts shared by every Multiset, capped near 10 MB
+PARTITIONS = PartitionTable(max_cells=2 ** 18)
+
 class Multiset(object):
 
     """Support math using multisets. Compute multinomial coefficient.
 
+    Factorials are cached in store, by default the FactorialStore
+    FACTORIALS that every instance shares. backend names the default
+    method of multinomial_coeff(), one of BACKENDS.
+
     """
 
-    def __init__(self, n=0):
-        self._data = {0: 1}
+    BACKENDS = ('factorial', 'primes')
+    # multisets weighed between checks of the checkpoint interval
+    CHECKPOINT_EVERY = 4096
+    # tasks per worker process of a parallel num_ways()
+    TASKS_PER_PROCESS = 32
+    # largest _box_table() built to balance those tasks
+    MAX_BOX_CELLS = 2 ** 21
+
+    def __init__(self, n=0, instrument=None, store=None, backend='factorial'):
+        if backend not in self.BACKENDS:
+            print "Unsupported backend %r; choose one of %s." % (
+                backend, self.BACKENDS)
+            raise ValueError
+        self._data = FACTORIALS if store is None else store
+        self._factorials = self._data.values
+        self.backend = backend
+        self.instrument = instrument
+        if instrument is not None:
+            self.factorial = self._counted_factorial
         if n > 0:
-            self._update_factorial(n)
-
-    def _update_factorial(self, n):
-        """Increment cache of computed factorials."""
-        for val in xrange(len(self._data), n + 1):
-            self._data[val] = val * self._data[val - 1]
+            self._data.factorial(n)
 
     def clear(self):
-        """Re-initialize Multiset instance."""
-        self._data.clear()
-        self._data[0] = 1
+        """Re-initialize Multiset instance.
+
+        Discards the factorials of a store passed to the constructor. The
+        shared store FACTORIALS is left intact, since other instances rely
+        on it; call FACTORIALS.clear() to discard it.
+
+        """
+
+        if self._data is not FACTORIALS:
+            self._data.clear()
 
     def factorial(self, n):
         """Return factorial from cache, updating cache as needed."""
-        try:
-            result = self._data[n]
-        except KeyError:
-            if not is_nonneg_int(n):
-                print "Factorial supports only non-negative integers."""
-                raise ValueError
-            self._update_factorial(n)
-            result = self._data[n]
-        return result
+        if n >= 0:
+            try:
+                result = self._factorials[n]
+            except (IndexError, TypeError):
+                result = None
+            if result is not None:
+                return result
+        if not is_nonneg_int(n):
+            print "Factorial supports only non-negative integers."""
+            raise ValueError
+        return self._data.factorial(int(n))
 
-    def multinomial_coeff(self, iterable):
+    def _counted_factorial(self, n):
+        """Return factorial(), counting cache hits and misses."""
+        counters = self.instrument.counters
+        if self._data.cached(n):
+            counters['factorial_hits'] += 1
+        else:
+            counters['factorial_misses'] += 1
+        return Multiset.factorial(self, n)
+
+    def log_factorial(self, n):
+        """Return natural log of factorial from cache, updating as needed.
+
+        Values come from math.lgamma(), so they are rounded but never
+        overflow, which suits arguments far too large for exact factorials.
+
+        """
+
+        if not is_nonneg_int(n):
+            print "Log factorial supports only non-negative integers."
+            raise ValueError
+        return self._data.log_factorial(int(n))
+
+    def multinomial_coeff(self, iterable, backend=None):
         """Calculate a multinomial coefficient.
 
         Inputs
           :grouping: iterable of one or more non-negative integers
+          :backend: 'factorial' divides cached factorials, while 'primes'
+                    multiplies prime powers (see multinomial_from_primes()),
+                    which is much faster once the total is in the
+                    thousands (default: the backend of the instance)
 
         Output
           :coefficient: number of ways to arrange a grouping of categories
@@ -74,6 +728,8 @@ class Multiset(object):
                 >>> mset = Multiset()
                 >>> mset.multinomial_coeff((1, 2, 3))
                 60
+                >>> mset.multinomial_coeff((1, 2, 3), backend='primes')
+                60
 
         """
 
@@ -84,6 +740,18 @@ class Multiset(object):
             raise
         if not iterable:
             raise ValueError
+        if backend is None:
+            backend = self.backend
+        if backend == 'primes':
+            values = list(iterable)
+            if not all(is_nonneg_int(val) for val in values):
+                print "Multinomial coefficient requires non-negative integers."
+                raise ValueError
+            return multinomial_from_primes([int(val) for val in values])
+        elif backend != 'factorial':
+            print "Unsupported backend %r; choose one of %s." % (
+                backend, self.BACKENDS)
+            raise ValueError
         total, denominator = 0, 1
         for val in iterable:
             total += val
@@ -120,7 +788,8 @@ class Multiset(object):
             freq[cnt] += 1
         return self.multinomial_coeff(freq.values())
 
-    def uniq_msets(self, total, length):
+    def uniq_msets(self, total, length, start=None, stop=None, buffer=False,
+                   reverse=False):
         """Yields every multisets of a given size that sum to a given value.
 
         Yields each and every multiset with a fixed sum by iterating
@@ -130,9 +799,19 @@ class Multiset(object):
         Input
             :total: sum of each multiset to be returned
             :length: maximum length of each multiset to be returned
+            :start: optional index of the first multiset to yield
+            :stop: optional index before which to stop; like a slice,
+                   start and stop may be negative or out of range
+            :buffer: if True, yield one list that is updated in place
+                     instead of a new tuple for each multiset
+            :reverse: if True, yield multisets in reverse order, starting
+                      from the largest leading element (start and stop
+                      then index the reversed order)
 
         Yields
             :iterable: a non-ascending sequence of non-negative integers
+                       (a tuple, or with buffer a shared list which the
+                       caller must copy to keep and must not modify)
 
         Implementation
             Non-ascending tuples are yielded in lexicographical order
@@ -146,6 +825,14 @@ class Multiset(object):
             however, both the order of the elements within tuples and the order
             of yielded tuples are exactly reversed.
 
+            Each step takes constant amortized time apart from re-flowing
+            the positions after the incremented element (see _walk_msets()).
+            Buffer mode builds no tuple per multiset; the re-flow still
+            builds short lists of the new values, which assigns a run
+            faster than a loop over its positions. A slice starts
+            walking from unrank(start), so equal shards of an enumeration
+            can run in separate processes or be resumed from any index.
+
         Examples
 
             >>> mset = Multiset()
@@ -158,6 +845,9 @@ class Multiset(object):
             >>> list(seq)
             [(4, 3, 3), (4, 4, 2), (5, 3, 2), (5, 4, 1), (5, 5, 0), (6, 2, 2), (6, 3, 1), (6, 4, 0), (7, 2, 1), (7, 3, 0), (8, 1, 1), (8, 2, 0), (9, 1, 0), (10, 0, 0)]
 
+            >>> list(mset.uniq_msets(10, 3, 2, 5))
+            [(5, 3, 2), (5, 4, 1), (5, 5, 0)]
+
         """
 
         n = int(total)
@@ -165,49 +855,308 @@ class Multiset(object):
         if not (is_nonneg_int(total) and is_nonneg_int(length)):
             print "Unique multisets require non-negative integers."""
             raise ValueError
+        sliced = start is not None or stop is not None
+        if sliced:
+            count = 1 if m <= 1 else self.num_uniq_msets(n, m)
+            (start, stop, step) = slice(start, stop).indices(count)
+            if stop <= start:
+                raise StopIteration
         if m == 0:
-            yield ()
+            yield [] if buffer else ()
             raise StopIteration
         if m == 1:
-            yield (n,)
+            yield [n] if buffer else (n,)
             raise StopIteration
 
-        seq = []
-        (quot, rem) = divmod(n, m)
-        for ix in xrange(m):
-            seq.append(quot + (rem > 0))
-            rem -= 1
-        pool = tuple(xrange(m - 1, -1, -1))
-        yield tuple(seq)
-        while seq[1] != 0:
+        seq = None
+        if sliced:
+            seq = list(self.unrank(n, m, count - 1 - start if reverse
+                                   else start))
+        if self.instrument is not None:
+            self.instrument.begin(stop - start if sliced
+                                  else self.num_uniq_msets(n, m))
+        walk = self._walk(n, m, [0, 0], seq, reverse=reverse)
+        if sliced and stop < count:
+            walk = islice(walk, stop - start)
+        if buffer:
+            for seq in walk:
+                yield seq
+        else:
+            for seq in imap(tuple, walk):
+                yield seq
+        raise StopIteration
+
+    def _walk(self, n, m, where, seq=None, fixed=0, reverse=False):
+        """Return _walk_msets() or, with reverse, _walk_msets_reversed().
+
+        With an instrument, each multiset visited is counted and the time
+        spent stepping to it is recorded.
+
+        """
+
+        if reverse:
+            walk = self._walk_msets_reversed(n, m, where, seq, fixed)
+        else:
+            walk = self._walk_msets(n, m, where, seq, fixed)
+        if self.instrument is not None:
+            walk = self.instrument.visit(walk)
+        return walk
+
+    def _walk_msets(self, n, m, where, seq=None, fixed=0):
+        """Yield one list updated in place to each multiset of uniq_msets().
+
+        Inputs
+          :n: sum of each multiset
+          :m: length of each multiset, at least 2
+          :where: list of length 2, updated before each yield with the
+                  leftmost position changed since the previous multiset
+                  and the position of the last positive element
+          :seq: optional multiset from which to start (default: the first)
+          :fixed: number of leading positions that may not change; the
+                  walk stops before the first step that would change one
+
+        Implementation
+            Each step decrements the last positive element, increments the
+            leftmost element of the run just before it, and re-flows the
+            remainder evenly over the positions to the right. Because that
+            run holds equal values and later positions hold zeros, the
+            remainder is known without summing the tail, and a remainder
+            smaller than the number of positions only rewrites positions
+            that were or become positive. Runs are rewritten by slice
+            assignment from temporary lists, which is faster in CPython
+            than assigning each position in a loop.
+
+        """
+
+        if seq is None:
+            seq = []
+            (quot, rem) = divmod(n, m)
+            for ix in xrange(m):
+                seq.append(quot + (rem > 0))
+                rem -= 1
+            last = m - 1 if quot else n - 1
+        else:
+            seq = list(seq)
+            last = m - 1
+            while last >= 0 and seq[last] == 0:
+                last -= 1
+        where[0] = 0
+        where[1] = last
+        yield seq
+        while last > 0:
             # decrement --> shift a unit leftward --> increment --> re-flow
-            for i in pool:
-                if seq[i] > 0:
-                    seq[i] -= 1
-                    j = i - 1
-                    while j > 0:
-                        if seq[j] < seq[j - 1]:
-                            break
-                        else:
-                            j -= 1
-                    seq[j] += 1
-
-                    (quot, rem) = divmod(sum(seq[j + 1:]), m - (j + 1))
-                    for k in xrange(j + 1, m):
-                        seq[k] = quot + (rem > 0)
-                        rem -= 1
-
-                    yield tuple(seq)
-                    break
+            val = seq[last - 1]
+            j = last - 1
+            while j > 0 and seq[j - 1] == val:
+                j -= 1
+            if j < fixed:
+                break
+            seq[last] -= 1
+            seq[j] = val + 1
+            # seq[j + 1:last] all equal val; later positions are zero
+            (quot, rem) = divmod((last - 1 - j) * val + seq[last], m - 1 - j)
+            if quot:
+                seq[j + 1:j + 1 + rem] = [quot + 1] * rem
+                seq[j + 1 + rem:] = [quot] * (m - 1 - j - rem)
+                last = m - 1
+            else:
+                seq[j + 1:j + 1 + rem] = [1] * rem
+                seq[j + 1 + rem:last + 1] = [0] * (last - j - rem)
+                last = j + rem
+            where[0] = j
+            where[1] = last
+            yield seq
+
+    def _walk_msets_reversed(self, n, m, where, seq=None, fixed=0):
+        """Yield one list updated in place in reverse order of uniq_msets().
+
+        Inputs are those of _walk_msets(), and the walk starts from
+        ``(n, 0, ..., 0)`` unless seq is given.
+
+        Implementation
+            Each step finds the rightmost position whose element can be
+            decremented while the positions to its right absorb one more
+            unit without exceeding it, then fills those positions
+            greedily with the largest values allowed, which gives the
+            lexicographically preceding multiset. Scanning stops at the
+            last positive element, so trailing zeros cost nothing.
+
+        """
+
+        if seq is None:
+            seq = [n] + [0] * (m - 1)
+            last = 0 if n else -1
+        else:
+            seq = list(seq)
+            last = m - 1
+            while last >= 0 and seq[last] == 0:
+                last -= 1
+        where[0] = 0
+        where[1] = last
+        yield seq
+        while True:
+            j = min(last, m - 2)
+            rest = seq[m - 1] if j < last else 0
+            while j >= 0 and rest >= (m - 1 - j) * (seq[j] - 1):
+                rest += seq[j]
+                j -= 1
+            if j < fixed:
+                break
+            val = seq[j] - 1
+            seq[j] = val
+            (full, rem) = divmod(rest + 1, val)
+            seq[j + 1:j + 1 + full] = [val] * full
+            stop = j + 1 + full
+            if rem:
+                seq[stop] = rem
+                stop += 1
+            if stop <= last:
+                seq[stop:last + 1] = [0] * (last + 1 - stop)
+            last = stop - 1
+            where[0] = j
+            where[1] = last
+            yield seq
+
+    def _weighted_walk(self, n, m, where, seq=None, fixed=0, reverse=False):
+        """Yield (seq, weight) for each multiset walked by _walk_msets().
+
+        Inputs are those of _walk_msets(); seq is the same shared list.
+        With reverse, the walk is that of _walk_msets_reversed().
+
+        Implementation
+            For the positive elements ``g[0] >= ... >= g[last]`` with
+            running sums ``s[t]`` and ``r[t]`` the position of ``g[t]``
+            within its run of equal values, the prefix products::
+
+                w[t] = w[t - 1] * C(s[t], g[t]) * (t + 1) / r[t]
+
+            are integers that equal the multinomial coefficient times the
+            number of arrangements of ``g[:t + 1]``. The weight is
+            ``w[last] * C(m, last + 1)``, which places the zeros. Only
+            the prefix products from the leftmost changed position onward
+            are updated, so each step costs as much as the walk itself.
+
+        """
+
+        factorial = self.factorial
+        binom = {}
+        choose_m = [1]
+        for pos in xrange(1, m + 1):
+            choose_m.append(choose_m[-1] * (m + 1 - pos) // pos)
+        sums = [0] * m
+        runs = [0] * m
+        prods = [1] * m
+        for seq in self._walk(n, m, where, seq, fixed, reverse):
+            (first, last) = where
+            if first:
+                acc = sums[first - 1]
+                run = runs[first - 1]
+                prod = prods[first - 1]
+                prev = seq[first - 1]
+            else:
+                (acc, run, prod, prev) = (0, 0, 1, None)
+            for pos in xrange(first, last + 1):
+                val = seq[pos]
+                acc += val
+                run = run + 1 if val == prev else 1
+                prev = val
+                try:
+                    coeff = binom[acc, val]
+                except KeyError:
+                    coeff = factorial(acc) // (factorial(val) *
+                                               factorial(acc - val))
+                    binom[acc, val] = coeff
+                prod = prod * coeff * (pos + 1) // run
+                sums[pos] = acc
+                runs[pos] = run
+                prods[pos] = prod
+            yield seq, prod * choose_m[last + 1]
+
+    def weighted_msets(self, total, length, buffer=False, reverse=False):
+        """Yield each multiset of uniq_msets() together with its weight.
+
+        Inputs
+          :total: sum of each multiset
+          :length: length of each multiset
+          :buffer: if True, yield the shared list of uniq_msets(buffer=True)
+          :reverse: if True, yield in the reverse order of uniq_msets()
+
+        Yields
+          :pair: tuple of a multiset and its weight, which is its
+                 multinomial coefficient times its number of arrangements
+                 (the number of the ``length ** total`` orderings of results
+                 that it represents), updated incrementally from the
+                 previous multiset
+
+        Example
+            ::
+
+                >>> mset = Multiset()
+                >>> list(mset.weighted_msets(5, 2))
+                [((3, 2), 20), ((4, 1), 10), ((5, 0), 2)]
+
+        """
+
+        n = int(total)
+        m = int(length)
+        if not (is_nonneg_int(total) and is_nonneg_int(length)) or m == 0:
+            print "Weighted multisets require a positive length."
+            raise ValueError
+        if m == 1:
+            yield ([n] if buffer else (n,)), 1
+            raise StopIteration
+
+        walk = self._weighted_walk(n, m, [0, 0], reverse=reverse)
+        if self.instrument is not None:
+            self.instrument.begin(self.num_uniq_msets(n, m))
+            walk = self.instrument.timed(walk, 'weight', 'enumerate')
+        if buffer:
+            for pair in walk:
+                yield pair
+        else:
+            for (seq, weight) in walk:
+                yield tuple(seq), weight
         raise StopIteration
 
-    def num_ways(self, total, length, key_len=1):
+    def _msets_with_prefix(self, total, length, prefix):
+        """Yield (multiset, weight) for multisets that start with prefix.
+
+        Multisets are yielded in the same lexicographic order as
+        weighted_msets(), starting from prefix followed by its most even
+        remainder, until the walk would change an element of prefix.
+
+        """
+
+        rest = total - sum(prefix)
+        size = length - len(prefix)
+        if size <= 1:
+            seq = prefix + (rest,) * size
+            yield seq, (self.multinomial_coeff(seq) *
+                        self.number_of_arrangements(seq))
+            raise StopIteration
+        (quot, rem) = divmod(rest, size)
+        start = prefix + (quot + 1,) * rem + (quot,) * (size - rem)
+        walk = self._weighted_walk(total, length, [0, 0], start, len(prefix))
+        if self.instrument is not None:
+            walk = self.instrument.timed(walk, 'weight', 'enumerate')
+        for (seq, weight) in walk:
+            yield tuple(seq), weight
+
+    def num_ways(self, total, length, key_len=1, processes=None,
+                 reverse=False, checkpoint=None, interval=60.0):
         """Yield (key, value) where value is the number of ways.
 
         Inputs
           :total: sum of each multiset
           :length: length of each multiset
           :key_len: number of largest multiset element(s) to use as key
+          :processes: optional number of worker processes; each key is
+                      summed independently by a process pool
+          :reverse: if True, yield keys in descending order
+          :checkpoint: optional path of a file to which progress is saved
+                       at least every interval seconds, and from which an
+                       interrupted run resumes (see _checkpointed_ways())
+          :interval: seconds between checkpoints
 
         Yields
           :ways: tuple consisting of a key that identifies a group and values
@@ -218,15 +1167,684 @@ class Multiset(object):
 
         Implementation
             Yields keys sharing the same lexicographic order as uniq_msets().
+            With processes, the multisets are divided into tasks of about
+            equal size by deeper prefixes than the key (see _tasks()), and
+            the tasks of each key are summed in key order as they complete.
+            At most ``2 * processes`` tasks are computed ahead of the
+            consumer, so stopping early (e.g., at a threshold) wastes
+            little work.
 
         """
+        if checkpoint is not None:
+            if processes is not None:
+                print "Checkpoints support only serial number of ways."
+                raise ValueError
+            return self._checkpointed_ways(total, length, key_len, reverse,
+                                           checkpoint, interval)
+        return self._num_ways(total, length, key_len, processes, reverse)
+
+    def _num_ways(self, total, length, key_len, processes, reverse):
+        """Yield the pairs of num_ways() without checkpoints."""
+        if processes is not None:
+            n = int(total)
+            m = int(length)
+            if not (is_nonneg_int(total) and is_nonneg_int(length)) or m == 0:
+                print "Parallel number of ways requires a positive length."
+                raise ValueError
+            instrument = self.instrument
+            if instrument is not None:
+                instrument.begin(self.num_uniq_msets(n, m))
+            tasks = self._tasks(n, m, key_len, self.TASKS_PER_PROCESS *
+                                processes, reverse)
+            pool = Pool(processes)
+            pending = deque()
+            (key, acc) = (None, 0)
+            try:
+                for task in chain(tasks, [None]):
+                    if task is not None:
+                        pending.append((task[0], pool.apply_async(
+                            _num_ways_for_prefixes, ((n, m, task[1]),))))
+                    # bound the work started ahead of the consumer
+                    while pending and (task is None or
+                                       len(pending) > 2 * processes):
+                        (cur, result) = pending.popleft()
+                        (ways, visited) = result.get()
+                        if instrument is not None:
+                            instrument.add(visited)
+                        if cur != key:
+                            if key is not None:
+                                yield (key[0] if key_len == 1 else key), acc
+                            (key, acc) = (cur, 0)
+                        acc += ways
+                if key is not None:
+                    yield (key[0] if key_len == 1 else key), acc
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+            raise StopIteration
         if key_len == 1:
-            get_key = itemgetter(0)          # very fast
+            get_key = lambda pair: pair[0][0]
         else:
-            get_key = lambda x: x[:key_len]
-        for (key, grp) in groupby(self.uniq_msets(total, length), get_key):
-            yield key, sum(self.multinomial_coeff(g) *
-                           self.number_of_arrangements(g) for g in grp)
+            get_key = lambda pair: tuple(pair[0][:key_len])
+        pairs = self.weighted_msets(total, length, True, reverse)
+        for (key, grp) in groupby(pairs, get_key):
+            yield key, sum(imap(itemgetter(1), grp))
+
+    def _tasks(self, total, length, key_len, count, reverse):
+        """Yield (key, prefixes) tasks of a parallel num_ways().
+
+        Inputs
+          :total: sum of each multiset
+          :length: positive length of each multiset
+          :key_len: number of leading elements of each key
+          :count: number of tasks sought
+          :reverse: if True, yield keys in descending order
+
+        Yields
+          :task: tuple of a key of num_ways() and a list of prefixes that
+                 start with it; the multisets starting with a prefix are
+                 yielded by _msets_with_prefix()
+
+        Implementation
+            A key whose multisets (counted by _box_table()) exceed
+            ``1 / count`` of them all is split into prefixes one element
+            longer, recursively, and consecutive prefixes of a key are
+            joined up to that size, so that one heavy key no longer
+            limits the speedup. When the table would exceed MAX_BOX_CELLS
+            each key is one task; total is then large, so keys are many.
+
+        """
+
+        keys = _prefixes(total, length, key_len, total)
+        if reverse:
+            keys = reversed(list(keys))
+        if (length + 1) * (total + 1) * (total + 2) // 2 > self.MAX_BOX_CELLS:
+            for key in keys:
+                yield key, [key]
+            raise StopIteration
+        layers = self._box_table(total, length)
+        grain = max(1, layers[length][total][total] // count)
+
+        def size(prefix):
+            rest = total - sum(prefix)
+            return layers[length - len(prefix)][rest][min(prefix[-1], rest)]
+
+        def split(prefix):
+            rest = total - sum(prefix)
+            parts = length - len(prefix)
+            if parts <= 1 or size(prefix) <= grain:
+                yield prefix
+                raise StopIteration
+            vals = xrange(-(-rest // parts), min(prefix[-1], rest) + 1)
+            for val in (reversed(vals) if reverse else vals):
+                for piece in split(prefix + (val,)):
+                    yield piece
+
+        for key in keys:
+            (group, acc) = ([], 0)
+            for prefix in split(key):
+                weight = size(prefix)
+                if group and acc + weight > grain:
+                    yield key, group
+                    (group, acc) = ([], 0)
+                group.append(prefix)
+                acc += weight
+            yield key, group
+
+    def _checkpointed_ways(self, total, length, key_len, reverse, path,
+                           interval):
+        """Yield the pairs of num_ways(), saving progress to a file.
+
+        The file holds JSON with the arguments, the pairs already
+        completed, the current key and its running sum, and the index (see
+        rank()) of the next multiset to weigh; it is replaced atomically
+        (see _atomic_write()). Resuming yields the completed pairs again
+        and continues the walk from unrank(index), so the output is the
+        same as that of an uninterrupted run. The file is left complete
+        when the walk finishes, so running again just replays it.
+
+        """
+
+        n = int(total)
+        m = int(length)
+        if not (is_nonneg_int(total) and is_nonneg_int(length)) or m == 0:
+            print "Checkpointed number of ways requires a positive length."
+            raise ValueError
+        params = {'total': n, 'length': m, 'key_len': key_len,
+                  'reverse': bool(reverse)}
+        state = dict(params, done=[], key=None, ways=0, index=0)
+        if os.path.exists(path):
+            saved_file = open(path)
+            try:
+                saved = json.load(saved_file)
+            finally:
+                saved_file.close()
+            if dict((name, saved[name]) for name in params) != params:
+                print "Checkpoint %s is for different arguments." % path
+                raise ValueError
+            state = saved
+        as_key = (lambda key: key) if key_len == 1 else tuple
+        for (key, ways) in state['done']:
+            yield as_key(key), ways
+        count = self.num_uniq_msets(n, m)
+        index = state['index']
+        if index == count:
+            raise StopIteration
+
+        def save():
+            state.update(key=key, ways=acc, index=index)
+            _atomic_write(path, json.dumps(state))
+
+        if self.instrument is not None:
+            self.instrument.begin(count - index)
+        seq = list(self.unrank(n, m, count - 1 - index if reverse else index))
+        (key, acc) = (state['key'], state['ways'])
+        if key is not None:
+            key = as_key(key)
+        every = self.CHECKPOINT_EVERY
+        deadline = time.time() + interval
+        for (seq, weight) in self._weighted_walk(n, m, [0, 0], seq,
+                                                 reverse=reverse):
+            cur = seq[0] if key_len == 1 else tuple(seq[:key_len])
+            if cur != key:
+                if key is not None:
+                    state['done'].append((key, acc))
+                    yield key, acc
+                (key, acc) = (cur, 0)
+            acc += weight
+            index += 1
+            if not index % every and time.time() >= deadline:
+                save()
+                deadline = time.time() + interval
+        state['done'].append((key, acc))
+        (key, acc) = (None, 0)
+        save()
+        yield state['done'][-1][0], state['done'][-1][1]
+
+    def uniq_msets_batches(self, total, length, batch_size=65536):
+        """Yield the multisets of uniq_msets() as rows of 2-D arrays.
+
+        Inputs
+          :total: sum of each multiset
+          :length: length of each multiset
+          :batch_size: largest number of rows in each array
+
+        Yields
+          :batch: numpy array of shape ``(rows, length)`` holding
+                  consecutive multisets in lexicographic order; every array
+                  is newly allocated and has batch_size rows except the last
+
+        Exceptions
+          raises ImportError when numpy is not installed
+
+        Implementation
+            Multisets are built a column at a time by _expand_msets(), in
+            numpy, and the arrays it yields are cut into batches.
+
+        """
+
+        if numpy is None:
+            raise ImportError("uniq_msets_batches() requires numpy")
+        size = int(batch_size)
+        m = int(length)
+        if size < 1 or m < 1:
+            print "Batches require a positive batch size and length."
+            raise ValueError
+        if not is_nonneg_int(total):
+            print "Unique multisets require non-negative integers."
+            raise ValueError
+        n = int(total)
+        pieces = self._expand_msets(numpy.empty((1, 0), numpy.int64),
+                                    numpy.array([n], numpy.int64), m, size)
+        (pending, rows) = ([], 0)
+        for piece in pieces:
+            pending.append(piece)
+            rows += len(piece)
+            while rows >= size:
+                merged = numpy.concatenate(pending)
+                yield merged[:size]
+                pending = [merged[size:]]
+                rows -= size
+        if rows:
+            yield numpy.concatenate(pending)
+
+    def _expand_msets(self, prefixes, rest, length, limit):
+        """Yield arrays of the multisets that extend prefixes, in order.
+
+        Inputs
+          :prefixes: 2-D int64 array of non-ascending prefixes, one a row
+          :rest: 1-D int64 array of the sum left for each prefix
+          :length: length of each multiset
+          :limit: rows above which the prefixes are split before they
+                  are extended, so that arrays stay near limit rows
+
+        Implementation
+            The next element of a prefix ranges from ``ceil(rest /
+            parts)`` (for parts positions left) to the smaller of rest
+            and the last element, so the children of every prefix are
+            built at once with numpy.repeat(), in lexicographic order.
+
+        """
+
+        (rows, pos) = prefixes.shape
+        parts = length - pos
+        if parts == 0:
+            yield prefixes
+            raise StopIteration
+        if parts == 1:
+            yield numpy.column_stack((prefixes, rest))
+            raise StopIteration
+        bound = prefixes[:, -1] if pos else rest
+        low = -(-rest // parts)
+        counts = numpy.minimum(bound, rest) - low + 1
+        children = int(counts.sum())
+        if children > limit and rows > 1:
+            for part in numpy.array_split(numpy.arange(rows),
+                                          -(-children // limit)):
+                for batch in self._expand_msets(prefixes[part], rest[part],
+                                                length, limit):
+                    yield batch
+            raise StopIteration
+        parent = numpy.repeat(numpy.arange(rows), counts)
+        firsts = numpy.cumsum(counts) - counts
+        vals = low[parent] + numpy.arange(children) - firsts[parent]
+        for batch in self._expand_msets(
+                numpy.column_stack((prefixes[parent], vals)),
+                rest[parent] - vals, length, limit):
+            yield batch
+
+    def batch_weights(self, batch, exact=True):
+        """Return the weight of each multiset in a 2-D array of multisets.
+
+        Inputs
+          :batch: 2-D array whose rows are non-ascending multisets (e.g.,
+                  from uniq_msets_batches())
+          :exact: if True, return Python integers in an object array;
+                  otherwise return float64 values computed from a table of
+                  log factorials, which is much faster but rounded
+
+        Output
+          :weights: 1-D array of the multinomial coefficient times the
+                    number of arrangements of each row, as computed by
+                    weighted_msets()
+
+        Implementation
+            Within a non-ascending row equal values are adjacent, so the
+            product of the factorials of the multiplicities is the product
+            over positions of the position within its run of equal values.
+
+        """
+
+        if numpy is None:
+            raise ImportError("batch_weights() requires numpy")
+        batch = numpy.asarray(batch)
+        (rows, m) = batch.shape
+        sums = batch.sum(axis=1)
+        top = max(int(sums.max()) if rows else 0, m)
+        pos = numpy.arange(m)
+        starts = numpy.empty(batch.shape, dtype=numpy.int64)
+        starts[:, 0] = 0
+        starts[:, 1:] = numpy.where(batch[:, 1:] == batch[:, :-1], 0, pos[1:])
+        ranks = pos - numpy.maximum.accumulate(starts, axis=1) + 1
+        if exact:
+            facts = numpy.array([self.factorial(val)
+                                 for val in xrange(top + 1)], dtype=object)
+            denominator = (facts[batch].prod(axis=1) *
+                           ranks.astype(object).prod(axis=1))
+            return facts[sums] * facts[m] // denominator
+        log_facts = numpy.array([lgamma(val + 1) for val in xrange(top + 1)])
+        return numpy.exp(log_facts[sums] + log_facts[m] -
+                         log_facts[batch].sum(axis=1) -
+                         numpy.log(ranks).sum(axis=1))
+
+    def num_ways_batched(self, total, length, batch_size=65536, exact=True):
+        """Yield (key, value) where value is the number of ways.
+
+        Inputs
+          :total: sum of each multiset
+          :length: length of each multiset
+          :batch_size: number of multisets weighted per numpy operation
+          :exact: if False, values are floats (see batch_weights())
+
+        Yields
+          :ways: the same (key, value) pairs as ``num_ways(total, length)``
+
+        Notes
+          Multisets are enumerated in numpy (see uniq_msets_batches()),
+          but exact weights are Python integers in object arrays, so
+          with exact=True weighing runs at the speed of Python big
+          integer arithmetic; only exact=False weighs at numpy speed.
+
+        """
+
+        key = None
+        ways = 0
+        for batch in self.uniq_msets_batches(total, length, batch_size):
+            weights = self.batch_weights(batch, exact)
+            (keys, starts) = numpy.unique(batch[:, 0], return_index=True)
+            sums = numpy.add.reduceat(weights, starts)
+            for (new_key, new_ways) in zip(keys.tolist(), sums.tolist()):
+                if new_key == key:
+                    ways += new_ways
+                else:
+                    if key is not None:
+                        yield key, ways
+                    (key, ways) = (new_key, new_ways)
+        if key is not None:
+            yield key, ways
+
+    def _bounded_counts(self, bound, limits):
+        """Return rows counting the ways to fill bins of bounded size.
+
+        Inputs
+          :bound: largest number of elements that a bin may hold
+          :limits: sequence whose j-th entry is the largest total needed
+                   for j bins (a negative entry means none are needed)
+
+        Output
+          :rows: list whose j-th entry is a list with ``rows[j][s]`` equal
+                 to the number of ways to place s distinguishable elements
+                 into j distinguishable bins holding at most bound each
+
+        Implementation
+            Placing the last of s elements into one of j bins gives the
+            recurrence (derived from ``P' = j * (P - x**b / b! * Q)`` for
+            ``P = E(x) ** j`` and ``Q = E(x) ** (j - 1)``, where E is the
+            exponential series truncated after ``x**b / b!``)::
+
+                rows[j][s] = j * (rows[j][s - 1] -
+                                  C(s - 1, b) * rows[j - 1][s - 1 - b])
+
+            which subtracts the arrangements where that bin would hold
+            ``b + 1`` elements. Rows below the largest requested one are
+            only filled as far as the recurrence reaches.
+
+        """
+
+        lim = list(limits)
+        for j in xrange(len(lim) - 1, 0, -1):
+            lim[j - 1] = max(lim[j - 1], lim[j] - bound - 1)
+        top = max(lim)
+        # binom[t - bound] == C(t, bound)
+        binom = [1]
+        for t in xrange(bound + 1, top):
+            binom.append(binom[-1] * t // (t - bound))
+        rows = []
+        prev = []
+        for (j, last) in enumerate(lim):
+            row = []
+            if last >= 0 and j == 0:
+                row = [1] + [0] * last
+            elif last >= 0:
+                row.append(1)
+                for s in xrange(1, min(bound, last) + 1):
+                    row.append(row[-1] * j)
+                for s in xrange(bound + 1, last + 1):
+                    row.append(j * (row[-1] -
+                                    binom[s - 1 - bound] * prev[s - 1 - bound]))
+            rows.append(row)
+            prev = row
+        return rows
+
+    def num_ways_bounded(self, total, length, bound):
+        """Return number of ways that no element of a multiset exceeds bound.
+
+        Inputs
+          :total: sum of each multiset
+          :length: length of each multiset
+          :bound: largest permitted element
+
+        Output
+          :ways: sum over every multiset whose largest element is at most
+                 bound of the number of distinct orderings of results
+                 corresponding to each arrangement of that multiset
+
+        Example
+            Of the 2 ** 5 ways to split 5 results between 2 workers,
+            20 leave no more than 3 results on either worker::
+
+                >>> mset = Multiset()
+                >>> mset.num_ways_bounded(5, 2, 3)
+                20
+
+        """
+
+        n = int(total)
+        m = int(length)
+        b = int(bound)
+        if not (is_nonneg_int(total) and is_nonneg_int(length)):
+            print "Bounded number of ways requires non-negative integers."
+            raise ValueError
+        if b < 0:
+            return int(n == 0 and m == 0)
+        if b >= n:
+            return m ** n
+        return self._bounded_counts(b, [-1] * m + [n])[m][n]
+
+    def bounded_ways_by_total(self, total, length, bound):
+        """Return num_ways_bounded() for every sum up to total.
+
+        Output
+          :ways: list whose element s is ``num_ways_bounded(s, length,
+                 bound)``, from a single pass of the recurrence in
+                 _bounded_counts(), which costs about as much as the
+                 largest sum alone
+
+        """
+
+        n = int(total)
+        m = int(length)
+        b = int(bound)
+        if not (is_nonneg_int(total) and is_nonneg_int(length)):
+            print "Bounded number of ways requires non-negative integers."
+            raise ValueError
+        if b < 0:
+            return [int(s == 0 and m == 0) for s in xrange(n + 1)]
+        return self._bounded_counts(b, [-1] * m + [n])[m]
+
+    def bounded_ways_by_length(self, total, lengths, bound):
+        """Return num_ways_bounded() for each of several lengths.
+
+        Output
+          :ways: list whose i-th element is ``num_ways_bounded(total,
+                 lengths[i], bound)``, from a single pass of the recurrence
+                 in _bounded_counts(), whose row for each length is built
+                 from the row for one fewer
+
+        """
+
+        n = int(total)
+        b = int(bound)
+        if not (is_nonneg_int(total) and
+                all(is_nonneg_int(m) for m in lengths)):
+            print "Bounded number of ways requires non-negative integers."
+            raise ValueError
+        lengths = [int(m) for m in lengths]
+        if b < 0 or b >= n or not lengths:
+            return [self.num_ways_bounded(n, m, b) for m in lengths]
+        limits = [-1] * (max(lengths) + 1)
+        for m in lengths:
+            limits[m] = n
+        rows = self._bounded_counts(b, limits)
+        return [rows[m][n] for m in lengths]
+
+    def num_ways_dp(self, total, length, reverse=False):
+        """Yield (key, value) where value is the number of ways.
+
+        Inputs
+          :total: sum of each multiset
+          :length: length of each multiset
+          :reverse: if True, yield keys in descending order
+
+        Yields
+          :ways: the same (key, value) pairs as ``num_ways(total, length)``,
+                 keyed by the largest element of each multiset
+
+        Implementation
+            Rather than enumerating uniq_msets(), the number of ways for
+            key k is the difference between num_ways_bounded() for
+            bounds k and ``k - 1``. Each bound costs roughly
+            ``total ** 2 / bound`` big integer operations, so the whole
+            table costs O(n ** 2 * log(n)) and never more than O(n ** 2 * m).
+
+            >>> mset = Multiset()
+            >>> list(mset.num_ways_dp(5, 2))
+            [(3, 20), (4, 10), (5, 2)]
+
+        """
+
+        n = int(total)
+        m = int(length)
+        if not (is_nonneg_int(total) and is_nonneg_int(length)) or m == 0:
+            print "Number of ways requires a positive length."
+            raise ValueError
+        lowest = -(-n // m)
+        if reverse:
+            upto = m ** n
+            for key in xrange(n, lowest - 1, -1):
+                below = self.num_ways_bounded(n, m, key - 1)
+                yield key, upto - below
+                upto = below
+            raise StopIteration
+        below = self.num_ways_bounded(n, m, lowest - 1)
+        for key in xrange(lowest, n + 1):
+            upto = self.num_ways_bounded(n, m, key)
+            yield key, upto - below
+            below = upto
+
+    def _box_table(self, total, length):
+        """Return counts of non-ascending sequences bounded by a maximum.
+
+        Output
+          :layers: nested lists where ``layers[l][s][c]``, for
+                   ``l <= length``, ``s <= total`` and ``c <= s``, is the
+                   number of non-ascending sequences of l non-negative
+                   integers that sum to s with every element at most c
+                   (the partitions of s that fit in an l by c box)
+
+        Implementation
+            Either no element equals c, or removing one element equal to c
+            leaves a sequence of ``l - 1`` elements summing to ``s - c``::
+
+                Q(s, l, c) = Q(s, l, c - 1) + Q(s - c, l - 1, c)
+
+            The table holds O(length * total ** 2) big integers and is not
+            kept, so callers bound its size (see _tasks()); a single count
+            comes from _BoxSeries instead.
+
+        """
+
+        layers = [[[1]] + [[0] * (s + 1) for s in xrange(1, total + 1)]]
+        while len(layers) <= length:
+            prev = layers[-1]
+            layer = [[1]]
+            for s in xrange(1, total + 1):
+                row = [0]
+                acc = 0
+                for c in xrange(1, s + 1):
+                    rest = s - c
+                    acc += prev[rest][min(c, rest)]
+                    row.append(acc)
+                layer.append(row)
+            layers.append(layer)
+        return layers
+
+    def rank(self, partition):
+        """Return the index of a multiset in the order of uniq_msets().
+
+        Inputs
+          :partition: a non-ascending sequence of non-negative integers
+
+        Output
+          :index: number of multisets with the same sum and length that
+                  uniq_msets() yields before partition
+
+        Implementation
+            The multisets before partition are those that agree with it
+            up to some position t and are smaller at t. With ``rest`` the
+            sum from position t onward, they number ``Q(rest, length - t,
+            partition[t] - 1)`` for each t (see _box_table()). Positions
+            are visited from the last, so the box of one _BoxSeries only
+            grows, in O((length + sum) * sum) operations and O(sum)
+            memory.
+
+        Example
+            ::
+
+                >>> mset = Multiset()
+                >>> mset.rank((5, 3, 2))
+                2
+                >>> mset.unrank(10, 3, 2)
+                (5, 3, 2)
+
+        """
+
+        seq = tuple(partition)
+        if not (all(is_nonneg_int(val) for val in seq) and
+                all(seq[ix] >= seq[ix + 1] for ix in xrange(len(seq) - 1))):
+            print "Rank requires a non-ascending sequence of integers."
+            raise ValueError
+        seq = tuple(int(val) for val in seq)
+        box = _BoxSeries(sum(seq))
+        (index, rest) = (0, 0)
+        for val in reversed(seq):
+            rest += val
+            box.resize(box.length + 1, max(box.bound, val - 1))
+            if val:
+                index += box.counts[rest]
+        return index
+
+    def unrank(self, total, length, index):
+        """Return the multiset at an index in the order of uniq_msets().
+
+        Inputs
+          :total: sum of the multiset
+          :length: length of the multiset
+          :index: position, counting from 0, among the multisets yielded
+                  by uniq_msets(total, length)
+
+        Output
+          :partition: tuple such that ``rank(partition) == index``
+
+        Implementation
+            Each element is the smallest value whose count of multisets
+            with no larger element exceeds the index, found by lowering
+            the bound of a _BoxSeries from the previous element; the
+            count below that value is then subtracted from the index.
+            Both the length and the bound of the box only shrink, so
+            this costs O((length + total) * total) operations and
+            O(total) memory.
+
+        """
+
+        if not (is_nonneg_int(total) and is_nonneg_int(length) and
+                is_nonneg_int(index)):
+            print "Unrank requires non-negative integers."
+            raise ValueError
+        rest = int(total)
+        m = int(length)
+        index = int(index)
+        box = _BoxSeries(rest)
+        box.resize(m, rest)
+        if index >= box.counts[rest]:
+            print "Index %d is out of range for %d multisets." % (
+                index, box.counts[rest])
+            raise ValueError
+        seq = []
+        for pos in xrange(m):
+            # counts[rest] exceeds the index with the bound at val
+            val = box.bound
+            while val:
+                box.resize(box.length, val - 1)
+                if box.counts[rest] <= index:
+                    index -= box.counts[rest]
+                    break
+                val -= 1
+            seq.append(val)
+            rest -= val
+            box.resize(box.length - 1, val)
+        return tuple(seq)
 
     def num_uniq_msets(self, total, length):
         """Compute number of unordered multisets with a given length and sum.
@@ -250,18 +1868,17 @@ class Multiset(object):
                  def num_uniq_msets(n, m):
                      return sum(1 for ms in uniq_msets(n, m))
 
+             Counts come from the shared PartitionTable PARTITIONS, which
+             is extended as needed up to its max_cells, so repeated calls
+             are lookups. Larger counts use a temporary rolling table of
+             ``O(min(total, length) ** 2)`` memory.
+
         """
 
-        n = int(total)
-        m = int(length)
-        nparts = [list([0] * (m + 1)) for row in xrange(n + 1)]
-        for i in xrange(n + 1):
-            nparts[i][1] = 1
-            for j in xrange(2, min(m, i) + 1):
-                nparts[i][j] = nparts[i - 1][j - 1] + nparts[i - j][j]
-        # for (ixn, r) in (nparts):
-        #    print 'n=%d %s' % (ixn, r)        # pretty table of values
-        return sum(nparts[n])
+        if not (is_nonneg_int(total) and is_nonneg_int(length)):
+            print "Counting multisets requires non-negative integers."
+            raise ValueError
+        return PARTITIONS.count(int(total), int(length))
 
     def multiset_number(self, total, length):
         """Compute multiset number.
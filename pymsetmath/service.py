@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""A local service answering miss probabilities for search routers.
+
+    A router needs, for each query, the probability that one of the top
+    N results is missed when each of m workers returns its top k. This
+    module serves that probability over a loopback HTTP port::
+
+        python -m pymsetmath.service --port 8765
+        curl 'http://127.0.0.1:8765/miss?n=100&m=10&k=20'
+        {"k": 20, "m": 10, "n": 100, "p": 0.008072198147...}
+
+    Paths
+      :/miss?n=&m=&k=: probability that some worker holds more than k
+                       of the top n results
+      :/table?n=&m=: the whole table, as columns 'count' and 'p'
+      :/stats: counters of the result cache
+
+    Invalid parameters are answered with status 400, a table predicted
+    to cost more than the service allows (see QueryService) with 503, a
+    table that takes longer than the service timeout with 504, and a
+    computation that fails with 500.
+
+    Each (n, m) table is computed once by compute_probabilities() and
+    kept in a least recently used cache, so that later queries for any
+    k are dictionary lookups. Concurrent requests for a table that is
+    still being computed wait for that one computation, rather than
+    starting their own. Computations run in process pools of fixed
+    size, one reserved for cheap tables, so a burst of expensive tables
+    neither exhausts the machine nor delays cheap tables or the threads
+    answering cached queries.
+
+:Author: Hy Carrinski
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+import json
+from multiprocessing import Pool, TimeoutError
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+import sys
+import threading
+from urlparse import parse_qs, urlparse
+
+from pymsetmath.examples import compute_probabilities, explain
+from pymsetmath.multiset import is_nonneg_int
+
+def _compute_table(n, m, precision):
+    """Return the (count, p) pairs of compute_probabilities(n, m)."""
+    return [(stats['count'], stats['p'])
+            for stats in compute_probabilities(n, m, engine='auto',
+                                               precision=precision)]
+
+def _compute_entry(n, m, precision):
+    """Return (table, None), or (None, error) if computing it failed.
+
+    Runs in a worker process, so the error reaches the service through a
+    pool callback, which Python 2 does not offer for exceptions.
+
+    """
+
+    try:
+        return _compute_table(n, m, precision), None
+    except Exception as error:
+        return None, error
+
+def _miss_from_table(table, k):
+    """Return the p of a table for a worker returning its top k results."""
+    count = k + 1
+    if count <= table[0][0]:
+        return 1.0
+    if count > table[-1][0]:
+        return 0.0
+    return table[count - table[0][0]][1]
+
+class QueryService(object):
+    """Miss probabilities with a cache of tables and coalesced computation.
+
+    Inputs
+      :processes: number of worker processes computing expensive tables
+      :max_tables: number of (n, m) tables kept in the cache
+      :precision: largest acceptable absolute error of p, passed to
+                  compute_probabilities(engine='auto') (default: exact)
+      :timeout: seconds to wait for a table before giving up
+      :max_cost: optional largest run time, in seconds as predicted by
+                 examples.explain(), of a table the service computes
+      :cheap_cost: tables predicted to take at most this many seconds
+                   run in a separate pool of cheap_processes processes,
+                   so that they never queue behind expensive tables
+
+    Notes
+      Methods are safe to call from many threads. The cache counts
+      'hits', 'misses' (tables computed) and 'coalesced' (requests that
+      waited for a computation started by another request).
+
+      >>> service = QueryService(processes=1)
+      >>> round(service.miss_probability(20, 4, 9), 6)
+      0.055457
+      >>> service.close()
+
+    """
+
+    def __init__(self, processes=2, max_tables=256, precision=None,
+                 timeout=3600.0, max_cost=None, cheap_cost=0.1,
+                 cheap_processes=1):
+        if not (is_nonneg_int(processes) and processes > 0 and
+                is_nonneg_int(cheap_processes) and cheap_processes > 0 and
+                is_nonneg_int(max_tables) and max_tables > 0):
+            print "The service requires positive processes and max_tables."
+            raise ValueError
+        self.max_tables = max_tables
+        self.precision = precision
+        self.timeout = timeout
+        self.max_cost = max_cost
+        self.cheap_cost = cheap_cost
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+        self._tables = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = Pool(processes)
+        self._cheap_pool = Pool(cheap_processes)
+
+    def cost(self, n, m):
+        """Return the predicted seconds to compute the table for (n, m)."""
+        return explain(n, m, precision=self.precision)['cost']
+
+    def admits(self, n, m):
+        """Return False if table(n, m) would refuse to compute the table."""
+        if self.max_cost is None:
+            return True
+        with self._lock:
+            if (n, m) in self._tables or (n, m) in self._pending:
+                return True
+        return self.cost(n, m) <= self.max_cost
+
+    def table(self, n, m):
+        """Return the list of (count, p) pairs for n results and m workers.
+
+        Inputs
+          :n: total number (e.g., total number of highest scoring results)
+          :m: number of workers
+
+        Output
+          :table: pairs of count and the probability that some worker
+                  holds count or more of the top n results, as the rows
+                  of compute_probabilities(n, m); shared with the cache,
+                  so callers must not modify it
+
+        Exceptions
+          raises ValueError for negative n or non-positive m, or for a
+          table whose predicted cost exceeds max_cost (see admits()),
+          multiprocessing.TimeoutError after timeout seconds, and the
+          exception raised by compute_probabilities() if it fails
+
+        Implementation
+            The first request for a table submits it to a pool, whose
+            callback publishes the result, or its exception, to an Event
+            on which every request waits. A request that times out
+            leaves the computation pending, so a later request for the
+            same table waits for it rather than submitting it again, and
+            each pool runs at most one task per distinct table. (A pool's
+            AsyncResult wakes only one waiter in Python 2, so it cannot
+            be shared.)
+
+        """
+
+        if not (is_nonneg_int(n) and is_nonneg_int(m)) or m == 0:
+            print "Queries require non-negative n and positive m."
+            raise ValueError
+        key = (int(n), int(m))
+        cost = None
+        submit = False
+        while True:
+            with self._lock:
+                table = self._tables.pop(key, None)
+                if table is not None:
+                    self._tables[key] = table
+                    self.stats['hits'] += 1
+                    return table
+                pending = self._pending.get(key)
+                if pending is not None:
+                    self.stats['coalesced'] += 1
+                    break
+                if cost is not None:
+                    pending = {'done': threading.Event()}
+                    self._pending[key] = pending
+                    self.stats['misses'] += 1
+                    submit = True
+                    break
+            # predict outside the lock, then look again
+            cost = self.cost(*key)
+            if self.max_cost is not None and cost > self.max_cost:
+                print "Table %r exceeds the cost ceiling of %s seconds." % (
+                    key, self.max_cost)
+                raise ValueError
+        if submit:
+            pool = self._cheap_pool if cost <= self.cheap_cost else self._pool
+            pool.apply_async(_compute_entry, key + (self.precision,),
+                             callback=lambda entry: self._publish(key, entry))
+        if not pending['done'].wait(self.timeout):
+            raise TimeoutError
+        if 'error' in pending:
+            raise pending['error']
+        return pending['table']
+
+    def _publish(self, key, entry):
+        """Cache a computed table, or record its error, and wake waiters."""
+        (table, error) = entry
+        with self._lock:
+            pending = self._pending.pop(key)
+            if error is None:
+                self._tables[key] = table
+                while len(self._tables) > self.max_tables:
+                    self._tables.popitem(last=False)
+        # a failed table is not cached, so a later request retries it
+        if error is None:
+            pending['table'] = table
+        else:
+            pending['error'] = error
+        pending['done'].set()
+
+    def miss_probability(self, n, m, k):
+        """Return the probability that some worker holds more than k results.
+
+        Inputs
+          :n: total number (e.g., total number of highest scoring results)
+          :m: number of workers
+          :k: number of results returned by each worker
+
+        Output
+          :p: probability that one or more of the top n results is missed,
+              the p of the row of compute_probabilities(n, m) whose count
+              is k + 1 (1.0 when k * m < n, 0.0 when k >= n)
+
+        """
+
+        if not is_nonneg_int(k):
+            print "Queries require a non-negative k."
+            raise ValueError
+        return _miss_from_table(self.table(n, m), int(k))
+
+    def close(self):
+        """Stop the worker processes."""
+        for pool in (self._pool, self._cheap_pool):
+            pool.terminate()
+            pool.join()
+
+def _parse(query, names):
+    """Return the values of names in query as integers.
+
+    Raises KeyError for a missing name and ValueError for a value that
+    is not an integer, or for a negative value or a zero m.
+
+    """
+
+    values = [int(query[name]) for name in names]
+    for (name, value) in zip(names, values):
+        if value < 0 or (name == 'm' and value == 0):
+            raise ValueError
+    return values
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer the GET requests described in the module docstring."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((key, values[-1])
+                     for (key, values) in parse_qs(url.query).items())
+        service = self.server.service
+        names = {'/miss': ('n', 'm', 'k'), '/table': ('n', 'm')}
+        if url.path == '/stats':
+            self._send(dict(service.stats, tables=len(service._tables)))
+            return
+        if url.path not in names:
+            self.send_error(404)
+            return
+        try:
+            values = _parse(query, names[url.path])
+        except (KeyError, ValueError):
+            self.send_error(400, 'expected non-negative integer n, '
+                                 'positive m (and k for /miss)')
+            return
+        if not service.admits(values[0], values[1]):
+            self.send_error(503, 'the table exceeds the cost ceiling')
+            return
+        try:
+            table = service.table(values[0], values[1])
+        except TimeoutError:
+            self.send_error(504, 'the table took longer than the timeout')
+            return
+        except Exception:
+            # a failed computation; later requests retry it
+            self.send_error(500, 'the table could not be computed')
+            return
+        body = dict(zip(names[url.path], values))
+        if url.path == '/miss':
+            body['p'] = _miss_from_table(table, values[2])
+        else:
+            body['count'] = [count for (count, p) in table]
+            body['p'] = [p for (count, p) in table]
+        self._send(body)
+
+    def _send(self, body):
+        """Send body as a JSON response."""
+        data = json.dumps(body, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def make_server(port=8765, host='127.0.0.1', verbose=False, **options):
+    """Return an HTTP server answering queries with a new QueryService.
+
+    Inputs
+      :port: port to listen on; 0 picks a free port (see server_address)
+      :host: address to listen on, loopback by default
+      :verbose: if True, log each request to stderr
+      :options: keyword arguments of QueryService()
+
+    Output
+      :server: a threaded HTTPServer whose service attribute is the
+               QueryService; call serve_forever() to answer requests,
+               then shutdown() and service.close()
+
+    """
+
+    service = QueryService(**options)
+    server = _ThreadingServer((host, port), _Handler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=8765,
+                      help='port to listen on [%default]')
+    parser.add_option('--host', default='127.0.0.1',
+                      help='address to listen on [%default]')
+    parser.add_option('-j', '--processes', type='int', default=2,
+                      help='worker processes computing tables [%default]')
+    parser.add_option('--max-tables', type='int', default=256,
+                      help='tables kept in the cache [%default]')
+    parser.add_option('--precision', type='float',
+                      help='largest acceptable absolute error of p '
+                           '(default: exact)')
+    parser.add_option('--max-cost', type='float',
+                      help='refuse tables predicted to take more seconds '
+                           '(default: no limit)')
+    parser.add_option('--cheap-cost', type='float', default=0.1,
+                      help='predicted seconds of the tables computed by a '
+                           'reserved process [%default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='log each request to stderr')
+    (options, args) = parser.parse_args(argv)
+    server = make_server(options.port, options.host, options.verbose,
+                         processes=options.processes,
+                         max_tables=options.max_tables,
+                         precision=options.precision,
+                         max_cost=options.max_cost,
+                         cheap_cost=options.cheap_cost)
+    print 'Serving on http://%s:%d/' % server.server_address
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,12 +13,29 @@
 """
 
 from decimal import Decimal
+import json
 import math
+import multiprocessing
+import os
 import random
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
+import urllib2
 
-from pymsetmath.multiset import is_nonneg_int, Multiset
-from pymsetmath import examples
+from pymsetmath.multiset import (is_nonneg_int, FactorialStore, FACTORIALS,
+                                  Instrument, Multiset, numpy,
+                                  PartitionTable, PARTITIONS, primes_upto)
+from pymsetmath import batch, examples, service
+
+def _fill_cache(path, n):
+    """Store the tables of n for several m in a shared cache."""
+    cache = examples.ProbabilityCache(path)
+    for m in xrange(1, 6):
+        cache.probabilities(n, m)
+    cache.close()
 
 class TestMultisetMath(unittest.TestCase):
 
@@ -52,10 +69,60 @@ class TestMultisetMath(unittest.TestCase):
 
     def test_clear_method(self):
         """Test clear method."""
+        private = Multiset(store=FactorialStore())
+        private.factorial(10)
+        self.assertTrue(len(private._data) > 10)
+        private.clear()
+        self.assertTrue(len(private._data) == 1)
         self.mset.factorial(10)
-        self.assertTrue(len(self.mset._data) > 10)
         self.mset.clear()
-        self.assertTrue(len(self.mset._data) == 1)
+        self.assertTrue(FACTORIALS.cached(10))
+
+    def test_factorial_store_is_shared(self):
+        """Test factorial store is shared."""
+        other = Multiset()
+        self.mset.factorial(50)
+        self.assertTrue(other._data is self.mset._data)
+        self.assertTrue(other._data.cached(50))
+        private = Multiset(store=FactorialStore())
+        self.assertFalse(private._data.cached(50))
+        self.assertEqual(private.factorial(5.0), 120)
+
+    def test_factorial_store_evicts_to_checkpoints(self):
+        """Test factorial store evicts to checkpoints."""
+        store = FactorialStore(max_bytes=20000, stride=16)
+        mset = Multiset(store=store)
+        for val in xrange(400, -1, -7):
+            self.assertEqual(mset.factorial(val), math.factorial(val))
+            self.assertTrue(store.nbytes <= 20000 + 16 * sys.getsizeof(
+                math.factorial(val)))
+        self.assertTrue(None in store.values)
+        self.assertTrue(all(store.values[val] is not None
+                            for val in xrange(0, len(store), 16)))
+        store.set_max_bytes(0)
+        self.assertEqual(store.nbytes, 0)
+        self.assertEqual(mset.factorial(399), math.factorial(399))
+        self.assertEqual(mset.log_factorial(399),
+                         Multiset().log_factorial(399))
+
+    def test_factorial_store_is_thread_safe(self):
+        """Test factorial store is thread safe."""
+        store = FactorialStore(max_bytes=5000, stride=8)
+        errors = []
+        def work(seed):
+            mset = Multiset(store=store)
+            rand = random.Random(seed)
+            for ix in xrange(200):
+                val = rand.randrange(300)
+                if mset.factorial(val) != math.factorial(val):
+                    errors.append(val)
+        threads = [threading.Thread(target=work, args=(seed,))
+                   for seed in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
 
     def test_is_nonneg_int_on_several_inputs(self):
         """Test is_nonneg_int on several inputs."""
@@ -88,6 +155,46 @@ class TestMultisetMath(unittest.TestCase):
         result = list(self.mset.uniq_msets(5, 2))
         self.assertEqual(len(result), len(set(result)))
 
+    def test_uniq_msets_buffer_mode_reuses_one_list(self):
+        """Test uniq_msets buffer mode reuses one list."""
+        for (n, m) in ((0, 3), (7, 1), (10, 3), (12, 5)):
+            expected = list(self.mset.uniq_msets(n, m))
+            seen = set()
+            result = []
+            for seq in self.mset.uniq_msets(n, m, buffer=True):
+                seen.add(id(seq))
+                result.append(tuple(seq))
+            self.assertEqual(result, expected)
+            self.assertEqual(len(seen), 1)
+
+    def test_uniq_msets_is_sorted_and_non_ascending(self):
+        """Test uniq_msets is sorted and non ascending."""
+        result = list(self.mset.uniq_msets(24, 6))
+        self.assertEqual(result, sorted(result))
+        for seq in result:
+            self.assertEqual(list(seq), sorted(seq, reverse=True))
+            self.assertEqual(sum(seq), 24)
+
+    def test_weighted_msets_matches_direct_weights(self):
+        """Test weighted_msets matches direct weights."""
+        for (n, m) in ((0, 4), (6, 1), (10, 3), (17, 6)):
+            expected = [(g, self.mset.multinomial_coeff(g) *
+                            self.mset.number_of_arrangements(g))
+                        for g in self.mset.uniq_msets(n, m)]
+            result = list(self.mset.weighted_msets(n, m))
+            self.assertEqual(result, expected)
+            self.assertEqual(sum(w for (g, w) in result), m ** n)
+
+    def test_uniq_msets_reverse_order(self):
+        """Test uniq_msets reverse order."""
+        for (n, m) in ((0, 3), (10, 3), (18, 6)):
+            expected = list(self.mset.uniq_msets(n, m))[::-1]
+            result = list(self.mset.uniq_msets(n, m, reverse=True))
+            self.assertEqual(result, expected)
+            expected = list(self.mset.weighted_msets(n, m))[::-1]
+            result = list(self.mset.weighted_msets(n, m, reverse=True))
+            self.assertEqual(result, expected)
+
     def test_num_ways_n_tuple_key(self):
         """Test num_ways n tuple key."""
         expected = (4, 5, 5)
@@ -137,6 +244,22 @@ class TestMultisetMath(unittest.TestCase):
         for (value, expected) in pairs:
             self.assertEqual(m_coeff(value), expected)
 
+    def test_multinomial_coeff_primes_backend(self):
+        """Test multinomial_coeff primes backend."""
+        m_coeff = self.mset.multinomial_coeff
+        for size in (1, 2, 3, 7):
+            for trial in xrange(20):
+                value = [random.randrange(200) for ix in xrange(size)]
+                self.assertEqual(m_coeff(value, backend='primes'),
+                                 m_coeff(value))
+        value = (3000, 1000, 1000, 7)
+        self.assertEqual(Multiset(backend='primes').multinomial_coeff(value),
+                         m_coeff(value))
+        self.assertEqual(primes_upto(30), [2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+        self.assertRaises(ValueError, m_coeff, (1, -1), backend='primes')
+        self.assertRaises(ValueError, m_coeff, (1, 2), backend='abacus')
+        self.assertRaises(ValueError, Multiset, backend='abacus')
+
     def test_number_arrangements_of_uniq_msets_is_mset_number(self):
         """Test number_arrangements of uniq_msets is mset number."""
         for n in (5, 15, 30):
@@ -146,6 +269,95 @@ class TestMultisetMath(unittest.TestCase):
                     for ms in self.mset.uniq_msets(n, m))
                 self.assertEqual(l1, l2)
 
+    def test_rank_unrank_and_slices(self):
+        """Test rank unrank and slices."""
+        for (n, m) in ((0, 3), (7, 1), (12, 4), (20, 6)):
+            expected = list(self.mset.uniq_msets(n, m))
+            for (index, grp) in enumerate(expected):
+                self.assertEqual(self.mset.rank(grp), index)
+                self.assertEqual(self.mset.unrank(n, m, index), grp)
+            for (start, stop) in ((None, 4), (3, None), (2, -1), (-5, 99)):
+                self.assertEqual(list(self.mset.uniq_msets(n, m, start, stop)),
+                                 expected[start:stop])
+                result = self.mset.uniq_msets(n, m, start, stop, reverse=True)
+                self.assertEqual(list(result), expected[::-1][start:stop])
+        self.assertRaises(ValueError, self.mset.rank, (1, 2))
+        self.assertRaises(ValueError, self.mset.unrank, 10, 3, 14)
+        # counts come from one series of the sum, not a table of boxes
+        seq = self.mset.unrank(2000, 100, 10 ** 40)
+        self.assertEqual((sum(seq), len(seq)), (2000, 100))
+        self.assertEqual(self.mset.rank(seq), 10 ** 40)
+
+    def test_num_ways_resumes_from_checkpoint(self):
+        """Test num_ways resumes from checkpoint."""
+        path = os.path.join(tempfile.mkdtemp(), 'ways.json')
+        self.mset.CHECKPOINT_EVERY = 50
+        for (key_len, reverse) in ((1, False), (2, True)):
+            expected = list(self.mset.num_ways(30, 5, key_len, None, reverse))
+            ways = self.mset.num_ways(30, 5, key_len, None, reverse, path, 0)
+            for ix in xrange(len(expected) // 2):
+                ways.next()
+            del ways
+            result = self.mset.num_ways(30, 5, key_len, None, reverse, path)
+            self.assertEqual(list(result), expected)
+            os.remove(path)
+        self.assertRaises(ValueError, list, examples.compute_probabilities(
+            30, 5, engine='dp', checkpoint=path))
+        rows = list(examples.compute_probabilities(30, 5, checkpoint=path))
+        self.assertEqual(rows, list(examples.compute_probabilities(30, 5)))
+        self.assertRaises(ValueError, list, self.mset.num_ways(
+            30, 6, checkpoint=path))
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_partition_table_counts(self):
+        """Test partition table counts."""
+        table = PartitionTable(20, 4)
+        rolling = PartitionTable(20, 6, rolling=True)
+        for (n, m) in ((0, 1), (7, 3), (20, 4), (25, 6)):
+            expected = list(self.mset.uniq_msets(n, m))
+            self.assertEqual(table.count(n, m), len(expected))
+            leading = table.leading_counts(n, m)
+            self.assertEqual(leading, [sum(1 for g in expected if g[0] == v)
+                                       for v in xrange(n + 1)])
+        self.assertEqual(table.total, 25)
+        self.assertEqual(rolling.count(20, 6), table.count(20, 6))
+        rolling.extend(40, 6)
+        self.assertEqual(rolling.count(40, 5), table.count(40, 5))
+        self.assertRaises(ValueError, rolling.count, 20, 6)
+        self.assertRaises(ValueError, rolling.extend, 40, 7)
+        capped = PartitionTable(max_cells=100)
+        self.assertEqual(capped.count(40, 5), table.count(40, 5))
+        self.assertEqual(capped.count(6, 1000), table.count(6, 6))
+        self.assertEqual((capped.total, capped.length), (6, 6))
+        self.assertEqual(self.mset.num_uniq_msets(50, 4000),
+                         table.count(50, 50))
+        for (n, m) in ((3, -1), (-1, 3), (2.5, 2)):
+            self.assertRaises(ValueError, self.mset.num_uniq_msets, n, m)
+
+    def test_log_factorial_matches_factorial(self):
+        """Test log_factorial matches factorial."""
+        for val in (0, 1, 5, 30, 170):
+            expected = math.log(self.mset.factorial(val))
+            self.assertAlmostEqual(self.mset.log_factorial(val), expected, 9)
+        self.assertRaises(ValueError, self.mset.log_factorial, -1)
+
+    def test_instrument_counts_and_reports_progress(self):
+        """Test instrument counts and reports progress."""
+        reports = []
+        instrument = Instrument(progress=reports.append, interval=0)
+        instrument.CHECK_EVERY = 100
+        mset = Multiset(instrument=instrument, store=FactorialStore())
+        expected = dict(Multiset().num_ways(30, 5))
+        self.assertEqual(dict(mset.num_ways(30, 5)), expected)
+        total = mset.num_uniq_msets(30, 5)
+        self.assertEqual(instrument.total, total)
+        self.assertEqual(instrument.counters['msets'], total)
+        self.assertEqual(len(reports), total // 100)
+        self.assertTrue(instrument.counters['factorial_misses'] > 0)
+        self.assertTrue(instrument.counters['factorial_hits'] > 0)
+        self.assertEqual(instrument.eta(), 0)
+        self.assertTrue('%d of %d' % (total, total) in instrument.summary())
+
     def test_num_uniq_msets_is_equal_to_calculated_number(self):
         """Test num_uniq_msets is equal to calculated number."""
         for n in (5, 15, 30):
@@ -154,6 +366,71 @@ class TestMultisetMath(unittest.TestCase):
                 l2 = sum(1 for ms in self.mset.uniq_msets(n, m))
                 self.assertEqual(l1, l2)
 
+    def test_num_ways_bounded_small_inputs(self):
+        """Test num_ways_bounded small inputs."""
+        pairs = (((5, 2, 3), 20), ((5, 2, 5), 32), ((5, 2, 2), 0),
+                 ((0, 3, 0), 1), ((4, 4, 1), 24))
+        for (value, expected) in pairs:
+            self.assertEqual(self.mset.num_ways_bounded(*value), expected)
+
+    def test_num_ways_dp_matches_num_ways(self):
+        """Test num_ways_dp matches num_ways."""
+        for n in (0, 1, 7, 20):
+            for m in (1, 2, 5):
+                l1 = list(self.mset.num_ways(n, m))
+                l2 = list(self.mset.num_ways_dp(n, m))
+                self.assertEqual(l1, l2)
+
+    def test_num_ways_with_processes_matches_serial(self):
+        """Test num_ways with processes matches serial."""
+        for key_len in (1, 2):
+            l1 = list(self.mset.num_ways(12, 4, key_len))
+            l2 = list(self.mset.num_ways(12, 4, key_len, processes=2))
+            self.assertEqual(l1, l2)
+        l1 = list(self.mset.num_ways(30, 6, reverse=True))
+        l2 = list(self.mset.num_ways(30, 6, processes=2, reverse=True))
+        self.assertEqual(l1, l2)
+        tasks = list(self.mset._tasks(30, 6, 1, 16, False))
+        self.assertEqual([key for (key, prefixes) in tasks],
+                         sorted(key for (key, prefixes) in tasks))
+        sizes = [sum(len(list(self.mset._msets_with_prefix(30, 6, prefix)))
+                     for prefix in prefixes) for (key, prefixes) in tasks]
+        self.assertEqual(sum(sizes), self.mset.num_uniq_msets(30, 6))
+        self.assertTrue(max(sizes) <= sum(sizes) // 16)
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_uniq_msets_batches_matches_uniq_msets(self):
+        """Test uniq_msets_batches matches uniq_msets."""
+        expected = list(self.mset.uniq_msets(15, 4))
+        batches = list(self.mset.uniq_msets_batches(15, 4, batch_size=7))
+        sizes = [len(b) for b in batches]
+        self.assertEqual(sizes, [7] * (len(sizes) - 1) + [sizes[-1]])
+        result = [tuple(row) for b in batches for row in b.tolist()]
+        self.assertEqual(result, expected)
+        for (n, m) in ((0, 3), (9, 1), (6, 9)):
+            result = [tuple(row) for b in self.mset.uniq_msets_batches(n, m, 2)
+                      for row in b.tolist()]
+            self.assertEqual(result, list(self.mset.uniq_msets(n, m)))
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_batch_weights_exact_and_approximate(self):
+        """Test batch_weights exact and approximate."""
+        pairs = list(self.mset.weighted_msets(25, 5))
+        batch = numpy.array([g for (g, w) in pairs])
+        expected = [w for (g, w) in pairs]
+        self.assertEqual(self.mset.batch_weights(batch).tolist(), expected)
+        approx = self.mset.batch_weights(batch, exact=False).tolist()
+        for (value, exact) in zip(approx, expected):
+            self.assertAlmostEqual(value / exact, 1.0, 10)
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_num_ways_batched_matches_num_ways(self):
+        """Test num_ways_batched matches num_ways."""
+        for batch_size in (1, 5, 1000):
+            l1 = list(self.mset.num_ways(14, 4))
+            l2 = list(self.mset.num_ways_batched(14, 4, batch_size))
+            self.assertEqual(l1, l2)
+
 class TestProbabilities(unittest.TestCase):
 
     """Test probability calculation examples."""
@@ -210,3 +487,442 @@ class TestProbabilities(unittest.TestCase):
         self.assertRaises(ValueError, ex_print, 1, 0, -1)
         self.assertRaises(ValueError, ex_print, 0, -1, 1)
         self.assertRaises(ValueError, ex_print, -1, 1, 0)
+
+    def test_ex_dp_engine_matches_enumeration(self):
+        """Test ex dp engine matches enumeration."""
+        for (n, m) in ((5, 2), (40, 4), (30, 7)):
+            l1 = list(examples.compute_all_probabilities(n, m))
+            l2 = list(examples.compute_all_probabilities(n, m, engine='dp'))
+            self.assertEqual(l1, l2)
+            l1 = list(examples.compute_probabilities(n, m, 9))
+            l2 = list(examples.compute_probabilities(n, m, 9, engine='dp'))
+            self.assertEqual(l1, l2)
+
+    def test_ex_dp_engine_beyond_float_range(self):
+        """Test ex dp engine beyond float range."""
+        result = list(examples.compute_all_probabilities(400, 10, engine='dp'))
+        self.assertEqual(result[0]['p'], 1.0)
+        self.assertEqual(result[-1]['count'], 400)
+        probs = [stats['p'] for stats in result]
+        self.assertEqual(probs, sorted(probs, reverse=True))
+        self.assertTrue(0.0 < probs[20] < 1.0)
+
+    def test_ex_unknown_engine(self):
+        """Test ex unknown engine."""
+        self.assertRaises(ValueError, examples.count_ways,
+                          Multiset(), 5, 2, 'abacus')
+
+    def test_ex_log_probabilities_within_error_bounds(self):
+        """Test ex log probabilities within error bounds."""
+        for (n, m) in ((20, 4), (60, 6), (150, 40)):
+            exact = examples.compute_all_probabilities(n, m, engine='dp')
+            approx = examples.compute_log_probabilities(n, m)
+            for (stats, result) in zip(exact, approx):
+                self.assertEqual(stats['count'], result['count'])
+                error = abs(result['p'] - stats['p'])
+                self.assertTrue(error <= result['rel_err'] * stats['p'])
+
+    def test_ex_log_probabilities_for_huge_inputs(self):
+        """Test ex log probabilities for huge inputs."""
+        result = list(examples.compute_log_probabilities(20000, 50, 600))
+        self.assertEqual(result[-1]['count'], 600)
+        self.assertTrue(result[-1]['log_p'] < -40)
+        self.assertTrue(result[-1]['rel_err'] < 1e-6)
+
+    def test_ex_solve_k_matches_probability_table(self):
+        """Test ex solve_k matches probability table."""
+        for (n, m) in ((20, 4), (60, 6), (33, 2), (9, 1)):
+            table = list(examples.compute_all_probabilities(n, m, engine='dp'))
+            for epsilon in (0.5, 0.01, 1e-6, 1e-20):
+                expected = min([s['count'] - 1 for s in table
+                                if s['p'] < epsilon] + [n])
+                self.assertEqual(examples.solve_k(n, m, epsilon), expected)
+
+    def test_ex_solve_k_for_large_n(self):
+        """Test ex solve_k for large n."""
+        for (n, m, epsilon) in ((1000, 64, 1e-9), (1000, 16, 1e-12)):
+            k = examples.solve_k(n, m, epsilon)
+            rows = list(examples.compute_probabilities(n, m, k + 1,
+                                                       engine='dp'))
+            self.assertEqual(rows[-1]['count'], k + 1)
+            self.assertTrue(rows[-1]['p'] < epsilon <= rows[-2]['p'])
+        # exact tables are out of reach here; the log rows bracket p
+        k = examples.solve_k(10000, 64, 1e-9)
+        rows = list(examples.compute_log_probabilities(10000, 64, k + 1))
+        (above, below) = rows[-2:]
+        self.assertEqual(below['count'], k + 1)
+        self.assertTrue(below['p'] * (1 + below['rel_err']) < 1e-9)
+        self.assertTrue(above['p'] * (1 - above['rel_err']) >= 1e-9)
+        self.assertEqual(examples.solve_k(10000, 64, 1e-9, exact=False), k)
+        self.assertRaises(ValueError, examples.solve_k, 10, 0, 0.1)
+        self.assertRaises(ValueError, examples.solve_k, 10, 2, 0)
+
+    def test_ex_tail_probabilities_match_all_probabilities(self):
+        """Test ex tail probabilities match all probabilities."""
+        for engine in ('enumerate', 'dp'):
+            expected = list(examples.compute_all_probabilities(30, 5))[::-1]
+            result = list(examples.compute_tail_probabilities(30, 5,
+                                                              engine=engine))
+            self.assertEqual(result, expected)
+
+    def test_ex_tail_probabilities_stop_above_epsilon(self):
+        """Test ex tail probabilities stop above epsilon."""
+        result = list(examples.compute_tail_probabilities(40, 4, 1e-3))
+        self.assertTrue(result[-1]['p'] > 1e-3)
+        self.assertTrue(all(stats['p'] <= 1e-3 for stats in result[:-1]))
+        self.assertEqual(result[0]['count'], 40)
+
+    def test_ex_probability_cache_round_trip_and_eviction(self):
+        """Test ex probability cache round trip and eviction."""
+        path = os.path.join(tempfile.mkdtemp(), 'tables.bin')
+        cache = examples.ProbabilityCache(path, max_bytes=3000)
+        self.assertEqual(cache.get(100, 10), None)
+        expected = list(examples.compute_all_probabilities(100, 10, 'dp'))
+        self.assertEqual(cache.probabilities(100, 10), expected)
+        # a new instance, as after a restart, reads the same file
+        self.assertEqual(examples.ProbabilityCache(path).get(100, 10),
+                         expected)
+        cache.probabilities(200, 10)
+        cache.probabilities(50, 5)
+        cache.get(100, 10)
+        cache.probabilities(150, 10)
+        self.assertEqual(cache.get(200, 10), None)
+        self.assertEqual(cache.get(100, 10), expected)
+        self.assertTrue(os.path.getsize(path) <= 3000)
+        cache.close()
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_ex_probability_cache_recovers_and_shares(self):
+        """Test ex probability cache recovers and shares."""
+        path = os.path.join(tempfile.mkdtemp(), 'tables.bin')
+        expected = list(examples.compute_all_probabilities(20, 4, 'dp'))
+        for data in ('', 'PMSC\x01'):
+            with open(path, 'wb') as cache_file:
+                cache_file.write(data)
+            cache = examples.ProbabilityCache(path)
+            self.assertEqual(cache.get(20, 4), None)
+            self.assertEqual(cache.probabilities(20, 4), expected)
+            self.assertEqual(cache.get(20, 4), expected)
+            cache.close()
+        with open(path, 'r+b') as cache_file:
+            cache_file.truncate(os.path.getsize(path) - 8)
+        self.assertEqual(examples.ProbabilityCache(path).get(20, 4), None)
+        os.remove(path)
+        examples.ProbabilityCache(path).put(20, 4, expected)
+        os.chmod(path, 0o444)
+        if not os.access(path, os.W_OK):
+            self.assertEqual(examples.ProbabilityCache(path).get(20, 4),
+                             expected)
+        os.remove(path)
+        workers = [multiprocessing.Process(target=_fill_cache,
+                                           args=(path, n))
+                   for n in (10, 11, 12, 13)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        cache = examples.ProbabilityCache(path)
+        for n in (10, 11, 12, 13):
+            for m in xrange(1, 6):
+                self.assertNotEqual(cache.get(n, m), None)
+        cache.close()
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_ex_probability_table_lookups(self):
+        """Test ex probability table lookups."""
+        path = os.path.join(tempfile.mkdtemp(), 'pymsetmath.table')
+        try:
+            grid = [(n, m) for n in (0, 5, 20) for m in (1, 2, 4)]
+            self.assertEqual(examples.build_table(path, grid + [(5, 2)]), 9)
+            table = examples.ProbabilityTable(path)
+            self.assertEqual(len(table), 9)
+            self.assertTrue((20, 4) in table and (20, 3) not in table)
+            for (n, m) in grid:
+                rows = list(examples.compute_all_probabilities(n, m))
+                self.assertEqual(list(table.values(n, m)),
+                                 [stats['p'] for stats in rows])
+                for stats in rows:
+                    self.assertEqual(table.p(n, m, stats['count'] - 1),
+                                     stats['p'])
+                for epsilon in (2, 1, 0.5, 1e-3, 1e-300):
+                    self.assertEqual(table.min_k(n, m, epsilon),
+                                     examples.solve_k(n, m, epsilon))
+            self.assertEqual((table.p(20, 4, 2), table.p(20, 4, 20)),
+                             (1.0, 0.0))
+            self.assertRaises(KeyError, table.p, 20, 3, 5)
+            self.assertRaises(ValueError, examples.build_table, path,
+                              [(5, 0)])
+            table.close()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_ex_expected_misses_and_miss_tails(self):
+        """Test ex expected misses and miss tails."""
+        for (n, m) in ((0, 3), (7, 1), (20, 4), (30, 3)):
+            table = dict((stats['count'] - 1, stats['p']) for stats in
+                         examples.compute_all_probabilities(n, m, 'dp'))
+            expected = list(examples.compute_expected_misses(n, m))
+            tails = list(examples.compute_miss_tails(n, m))
+            self.assertEqual(len(expected), n + 1)
+            self.assertEqual(len(tails), n + 1)
+            for (stats, tail) in zip(expected, tails):
+                k = stats['k']
+                self.assertEqual(tail['expected'], stats['expected'])
+                self.assertAlmostEqual(sum(tail['tail'][1:]),
+                                       stats['expected'], 9)
+                self.assertEqual(len(tail['tail']), max(n - k, 0) + 1)
+                self.assertEqual(tail['tail'][0], 1.0)
+                self.assertAlmostEqual(
+                    tail['p'], table.get(k, float(k < min(table))), 12)
+            self.assertEqual(expected[-1]['recall'], 1.0)
+        self.assertEqual(expected[0]['expected'], 30.0)
+        self.assertEqual(len(list(examples.compute_miss_tails(30, 3, 12))),
+                         13)
+        for k in (0, 20, 45, 200):
+            self.assertEqual(sum(examples._miss_counts(200, 7, k)), 7 ** 200)
+        self.assertRaises(ValueError, list,
+                          examples.compute_expected_misses(5, 0))
+
+    def test_ex_weighted_probabilities(self):
+        """Test ex weighted probabilities."""
+        uniform = list(examples.compute_all_probabilities(40, 5, 'dp'))
+        self.assertEqual(list(examples.compute_weighted_probabilities(
+            40, [0.2] * 5)), uniform)
+        self.assertEqual(list(examples.compute_weighted_probabilities(
+            40, [3] * 5, t=12)), uniform[:5])
+        # brute force over the 3 ** 6 assignments with weights 1, 1, 2
+        (n, weights) = (6, (1, 1, 2))
+        ways = {}
+        for code in xrange(3 ** n):
+            (held, weight) = ([0, 0, 0], 1)
+            for pos in xrange(n):
+                shard = code // 3 ** pos % 3
+                held[shard] += 1
+                weight *= weights[shard]
+            ways[max(held)] = ways.get(max(held), 0) + weight
+        remaining = 4 ** n
+        for stats in examples.compute_weighted_probabilities(n, weights):
+            self.assertEqual(stats['p'], remaining / float(4 ** n))
+            remaining -= ways.get(stats['count'], 0)
+        self.assertEqual(stats['count'], n)
+        rows = list(examples.compute_weighted_probabilities(5, (0, 1, 1)))
+        self.assertEqual([stats['count'] for stats in rows], [3, 4, 5])
+        self.assertEqual(rows[0]['m'], 3)
+        for weights in ((), (0, 0), (1, -1)):
+            self.assertRaises(ValueError, list,
+                              examples.compute_weighted_probabilities(
+                                  5, weights))
+
+    def test_ex_sweep_n_matches_each_table(self):
+        """Test ex sweep_n matches each table."""
+        for m in (1, 3, 7):
+            sweep = list(examples.sweep_n(30, m))
+            self.assertEqual([n for (n, table) in sweep], range(1, 31))
+            for (n, table) in sweep:
+                expected = list(examples.compute_all_probabilities(n, m))
+                self.assertEqual(table, expected)
+        self.assertRaises(ValueError, list, examples.sweep_n(10, 0))
+
+    def test_ex_sweep_m_matches_each_table(self):
+        """Test ex sweep_m matches each table."""
+        for n in (0, 1, 25):
+            columns = examples.sweep_m(n, (6, 1, 3, 6, 30))
+            rows = zip(columns['m'], columns['count'], columns['p'])
+            expected = [(m, stats['count'], stats['p']) for m in (1, 3, 6, 30)
+                        for stats in examples.compute_all_probabilities(n, m)]
+            self.assertEqual(rows, expected)
+            self.assertEqual(columns['n'], n)
+        self.assertRaises(ValueError, examples.sweep_m, 10, (2, 0))
+        self.assertRaises(ValueError, examples.sweep_m, 10, ())
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_ex_sampled_probabilities_cover_exact_values(self):
+        """Test ex sampled probabilities cover exact values."""
+        exact = list(examples.compute_all_probabilities(30, 4))
+        result = list(examples.compute_sampled_probabilities(
+            30, 4, precision=0.01, confidence=0.999, seed=7))
+        self.assertEqual(result, list(examples.compute_sampled_probabilities(
+            30, 4, precision=0.01, confidence=0.999, seed=7)))
+        for (stats, estimate) in zip(exact, result):
+            self.assertEqual(stats['count'], estimate['count'])
+            if stats['p'] > 1e-3:
+                self.assertTrue(estimate['p_low'] <= stats['p'] <=
+                                estimate['p_high'])
+            self.assertTrue(estimate['p_high'] - estimate['p_low'] <= 0.02)
+        result = list(examples.compute_sampled_probabilities(30, 4, t=12,
+                                                             seed=7))
+        self.assertEqual(result[-1]['count'], 12)
+        self.assertEqual(list(examples.compute_sampled_probabilities(
+            10, 2, t=3, seed=7)), [])
+        self.assertEqual(list(examples.compute_probabilities(10, 2, t=3)), [])
+        self.assertAlmostEqual(examples.normal_quantile(0.975), 1.959964, 6)
+        result = list(examples.compute_sampled_probabilities(
+            30, 4, seed=7, max_samples=5))
+        self.assertTrue(all(row['samples'] == 5 for row in result))
+        self.assertFalse(any(row['p'] != row['p'] for row in result))
+        for bad in ({'max_samples': 0}, {'batch_size': 0}):
+            self.assertRaises(ValueError, list,
+                              examples.compute_sampled_probabilities(
+                                  30, 4, **bad))
+
+    def test_ex_explain_and_auto_engine(self):
+        """Test ex explain and auto engine."""
+        plan = examples.explain(1000, 64)
+        self.assertEqual((plan['engine'], plan['exact']), ('dp', True))
+        self.assertEqual(plan['order'][0], 'dp')
+        self.assertTrue('enumerate' in plan['costs'])
+        self.assertFalse('log' in plan['costs'])
+        self.assertTrue('log' in examples.explain(1000, 64,
+                                                  precision=0.01)['costs'])
+        self.assertEqual(list(examples.compute_probabilities(100, 10, 21,
+                                                             engine='auto')),
+                         list(examples.compute_probabilities(100, 10, 21,
+                                                             engine='dp')))
+        exact = list(examples.compute_probabilities(2000, 100, 60,
+                                                    engine='dp'))
+        result = list(examples.compute_probabilities(2000, 100, 60,
+                                                     engine='auto',
+                                                     precision=0.01, seed=0))
+        self.assertEqual(result, list(examples.compute_probabilities(
+            2000, 100, 60, engine='auto', precision=0.01, seed=0)))
+        for (stats, estimate) in zip(exact, result):
+            self.assertEqual(stats['count'], estimate['count'])
+            self.assertTrue(abs(stats['p'] - estimate['p']) <= 0.01)
+        # only 'enumerate' checkpoints, so auto uses it
+        path = os.path.join(tempfile.mkdtemp(), 'ways.json')
+        self.assertEqual(list(examples.compute_probabilities(
+            20, 4, engine='auto', checkpoint=path)),
+            list(examples.compute_probabilities(20, 4, engine='dp')))
+        shutil.rmtree(os.path.dirname(path))
+        self.assertRaises(ValueError, examples.explain, 10, 0)
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+        self.server = service.make_server(port=0, processes=1, max_tables=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://%s:%d' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.service.close()
+        self.thread.join()
+
+    def get(self, path):
+        return json.loads(urllib2.urlopen(self.url + path).read())
+
+    def test_service_answers_miss_probabilities(self):
+        """Test service answers miss probabilities."""
+        expected = dict((stats['count'], stats['p'])
+                        for stats in examples.compute_all_probabilities(20, 4))
+        for k in (0, 4, 9, 19, 20):
+            body = self.get('/miss?n=20&m=4&k=%d' % k)
+            self.assertEqual((body['n'], body['m'], body['k']), (20, 4, k))
+            self.assertEqual(body['p'], expected.get(k + 1, float(k < 5)))
+        body = self.get('/table?n=20&m=4')
+        self.assertEqual(body['count'], sorted(expected))
+        self.assertEqual(self.get('/stats')['misses'], 1)
+        for path in ('/miss?n=20&m=0&k=3', '/miss?n=20&m=4', '/nowhere'):
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              self.url + path)
+
+    def status(self, path):
+        try:
+            return urllib2.urlopen(self.url + path).getcode()
+        except urllib2.HTTPError as error:
+            return error.code
+
+    def test_service_reports_failed_computations(self):
+        """Test service reports failed computations."""
+        queries = self.server.service
+        queries.timeout = 0.001
+        for ix in xrange(3):
+            self.assertEqual(self.status('/table?n=3000&m=60'), 504)
+        # timeouts wait for the one running task rather than adding more
+        self.assertEqual(queries.stats['misses'], 1)
+        self.assertEqual(queries.stats['coalesced'], 2)
+        self.assertEqual(list(queries._pending), [(3000, 60)])
+        # cheap tables do not queue behind it
+        queries.timeout = 60.0
+        self.assertEqual(self.status('/miss?n=20&m=4&k=3'), 200)
+        queries.precision = -1.0
+        self.assertEqual(self.status('/table?n=21&m=4'), 500)
+        self.assertEqual(self.status('/miss?n=20&m=4&k=x'), 400)
+        self.assertEqual(self.status('/miss?n=20&m=4&k=-1'), 400)
+        queries.precision = None
+        queries.max_cost = 1.0
+        self.assertEqual(self.status('/table?n=2000&m=50'), 503)
+        self.assertRaises(ValueError, queries.table, 2000, 50)
+        self.assertEqual(self.status('/miss?n=20&m=4&k=3'), 200)
+
+    def test_service_coalesces_and_evicts_tables(self):
+        """Test service coalesces and evicts tables."""
+        queries = service.QueryService(processes=1, max_tables=2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            queries.miss_probability(60, 6, 20))) for ix in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(queries.stats['misses'], 1)
+        self.assertEqual(queries.stats['hits'] + queries.stats['coalesced'], 7)
+        for n in (10, 11, 12):
+            queries.table(n, 3)
+        self.assertEqual(list(queries._tables), [(11, 3), (12, 3)])
+        queries.close()
+
+class TestBatch(unittest.TestCase):
+
+    def test_batch_answers_queries_in_input_order(self):
+        """Test batch answers queries in input order."""
+        lines = ['{"n": 20, "m": 4, "t": 10}', '', '{"n": 20, "m": 4}',
+                 'not json', '{"n": 20, "m": 4, "t": 10}',
+                 '{"n": 20, "m": 4, "t": 2}', '{"n": 20, "m": 0}']
+        pairs = list(batch.read_queries(lines))
+        self.assertEqual([number for (number, query) in pairs],
+                         [1, 3, 4, 5, 6, 7])
+        self.assertEqual(pairs[0][1], (20, 4, 10))
+        self.assertEqual(list(batch.read_queries(['n,m,t', '20, 4,10'])),
+                         [(2, (20, 4, 10))])
+        table = list(examples.compute_all_probabilities(20, 4))
+        serial = list(batch.run_batch(pairs, window=2))
+        self.assertEqual(serial[0], {'n': 20, 'm': 4, 't': 10,
+                                     'p': table[5]['p']})
+        self.assertEqual(serial[1]['count'],
+                         [stats['count'] for stats in table])
+        self.assertEqual(serial[2], {'line': 4,
+                                     'error': 'expected a JSON object'})
+        self.assertEqual(serial[3], serial[0])
+        self.assertEqual(serial[4]['p'], 1.0)
+        self.assertTrue('error' in serial[5])
+        self.assertEqual(list(batch.run_batch(pairs, processes=2)), serial)
+        self.assertRaises(ValueError, list,
+                          batch.run_batch(pairs, engine='guess'))
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_batch_reports_failed_queries_by_line(self):
+        """Test batch reports failed queries by line."""
+        pairs = [(1, (20, 4, 10)), (2, (20, 4, 9)), (3, (20, 4, 10))]
+        for processes in (None, 2):
+            # sampling rejects a negative precision inside the worker
+            result = list(batch.run_batch(pairs, processes, precision=-1.0))
+            self.assertEqual([row['line'] for row in result], [1, 2, 3])
+            self.assertTrue(all('error' in row for row in result))
+        result = list(batch.run_batch(pairs, 2, window=1))
+        self.assertEqual(result[0], result[2])
+        self.assertEqual(result[1]['t'], 9)
+
+    def test_batch_mixed_shapes_keep_partition_table_bounded(self):
+        """Test batch mixed shapes keep partition table bounded."""
+        pairs = [(1, (4000, 50, 2)), (2, (50, 4000, 2)), (3, (4000, 50, 2))]
+        result = list(batch.run_batch(pairs))
+        self.assertEqual(result[0], result[2])
+        self.assertEqual(result[0]['p'], 1.0)
+        expected = list(examples.compute_probabilities(50, 4000, 2, 'dp'))
+        self.assertEqual(result[1]['p'], expected[-1]['p'])
+        self.assertTrue((PARTITIONS.total + 1) * (PARTITIONS.length + 1) <=
+                        PARTITIONS.max_cells)